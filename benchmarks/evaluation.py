@@ -0,0 +1,57 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+#
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Benchmark of the filter and map commands over large flows
+# Compares compiled expressions with the former evaluation of the source
+# string for every item
+
+import os, sys, timeit
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', 'src'))
+
+from pyircbot.core import BotFactory
+from pyircbot.evaluation import ListBulkingBotProtocol
+
+def legacy_eval (expr, **kwargs):
+	if set(':_').intersection(expr):
+		return None
+	return eval (expr, {'__builtins__':None},kwargs)
+
+def legacy_filter (flow, expr):
+	return filter (lambda x: legacy_eval (expr, x=x), flow)
+
+def legacy_map (flow, expr):
+	return map (lambda x: legacy_eval (expr, x=x), flow)
+
+def timed (function):
+	return min (timeit.repeat (function, number = 1, repeat = 3))
+
+if __name__ == '__main__':
+	size = int (sys.argv[1]) if len (sys.argv) > 1 else 100000
+	flow = [str (i) for i in range (size)]
+	bot = ListBulkingBotProtocol ()
+	bot.factory = BotFactory ('bench', None, [], '!', '->')
+	bot.factory.sandboxworkers = 0
+	for name, expr in (('filter', 'x.endswith ("7") and x > "100"'), ('map', 'x + "!" if x[0] == "1" else x * 2')):
+		legacy = {'filter': legacy_filter, 'map': legacy_map}[name]
+		command = getattr (bot, name)
+		assert list (command (flow, [], None, None, expr)) == legacy (flow, expr)
+		before = timed (lambda: legacy (flow, expr))
+		after = timed (lambda: list (command (flow, [], None, None, expr)))
+		print '%6s over %d items: before %6.3fs, after %6.3fs, speedup x%.1f' % (
+			name, size, before, after, before / after)
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+#
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Micro-benchmark of the parse and dispatch cost of BotProtocol._handle
+# Compares the compiled pipeline plans with the former implementation that
+# parsed, checked and resolved every message again; both run the same
+# stages and record the same metrics
+
+import os, sys, timeit
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', 'src'))
+
+from pyircbot.core import BotFactory
+from pyircbot.evaluation import ListBulkingBotProtocol
+from pyircbot.permissions import HostPermissionBotProtocol
+from twisted.internet.defer import Deferred
+from twisted.test.proto_helpers import StringTransport
+from time import time
+
+USER = 'alice!alice@example.org'
+MESSAGE = 'cat a b c->cat d e->echo'
+
+class BenchBotProtocol (ListBulkingBotProtocol, HostPermissionBotProtocol):
+	pass
+
+class LegacyBotProtocol (BenchBotProtocol):
+	'''
+	Parses, checks and resolves every message again, then runs the same
+	stages, metrics included, as the compiled plans
+	'''
+	def _handle (self, user, channel, message, wrap = False, alive = None):
+		commands = message.split('->')
+		commands = [x.split(' ') for x in commands]
+		commands = [(words[0], words[1:]) for words in commands]
+
+		d = Deferred()
+		metrics = self.factory.metrics
+		metrics.count ('messages')
+		start = time ()
+		permit = all([self._check (user, channel, command, args) for command, args in commands])
+		metrics.observe ('check_seconds', None, time () - start)
+		if not permit:
+			metrics.count ('denied')
+			return d
+		functions = [getattr (self, command) for command, args in commands]
+		if [command for command, args in commands if not self.commands[command].accepts (len (args))]:
+			return d
+		if wrap:
+			command, args = commands[0]
+			d.addCallback(self._setup, [], user, channel, command, args)
+		for function, (command, args) in zip (functions, commands):
+			out = []
+			d.addCallback(self._stage, function, command, out, user, channel, *args)
+			d.addErrback(self._error, out, user, channel, command, args)
+		if wrap:
+			command, args = commands[-1]
+			d.addCallback(self._teardown, out, user, channel, command, args)
+		return d
+
+def build (protocol, rules):
+	factory = BotFactory ('bench', None, [], '!', '->')
+	factory.permissions = {}
+	for command in ('cat', 'echo', 'map', 'filter'):
+		factory.permissions[command] = ['nobody%d!.*@.*' % i for i in range (rules)] + ['alice!.*']
+	bot = protocol ()
+	bot.factory = factory
+	bot.makeConnection (StringTransport ())
+	return bot
+
+def run (bot, number):
+	def handle ():
+		bot._handle (USER, '#bench', MESSAGE, True).callback (None)
+		bot.transport.clear ()
+	return min (timeit.repeat (handle, number = number, repeat = 3)) / number
+
+if __name__ == '__main__':
+	number = int (sys.argv[1]) if len (sys.argv) > 1 else 300
+	for rules in (1, 50, 200):
+		before = run (build (LegacyBotProtocol, rules), number)
+		after = run (build (BenchBotProtocol, rules), number)
+		print '%4d rules: before %7.2fus, after %7.2fus, speedup x%.1f' % (
+			rules, before * 1e6, after * 1e6, before / after)
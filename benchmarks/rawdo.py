@@ -0,0 +1,57 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+#
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Benchmark of the raw command rules checked by RawBotProtocol.do
+# Compares the compiled allow/deny matchers with the former loops over every
+# regular expression
+
+import os, re, sys, timeit
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', 'src'))
+
+from pyircbot.utils import RawMatcher
+
+def legacy (rules, args):
+	allowed = False
+	for regexp in rules[0]:
+		if re.search (regexp, args):
+			allowed = True
+	for regexp in rules[1]:
+		if re.search (regexp, args):
+			allowed = False
+	return allowed
+
+def build (count):
+	allow = ['^#chan%d( |$)' % i for i in range (count)]
+	deny = ['^#chan%d .*secret' % i for i in range (0, count, 2)]
+	return allow, deny
+
+if __name__ == '__main__':
+	number = int (sys.argv[1]) if len (sys.argv) > 1 else 20
+	for count in (10, 100, 300):
+		rules = build (count)
+		matcher = RawMatcher (*rules)
+		samples = ['#chan%d hello' % (count - 1), '#chan0 secret', '#nowhere']
+		for args in samples:
+			assert legacy (rules, args) == matcher.check (args)[0]
+		before = min (timeit.repeat (lambda: [legacy (rules, args) for args in samples],
+		                             number = number, repeat = 3)) / number / len (samples)
+		after = min (timeit.repeat (lambda: [matcher.check (args) for args in samples],
+		                            number = number, repeat = 3)) / number / len (samples)
+		print '%4d rules: before %8.2fus, after %7.2fus, speedup x%.1f' % (
+			count, before * 1e6, after * 1e6, before / after)
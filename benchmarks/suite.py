@@ -0,0 +1,76 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+#
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Throughput and latency benchmark of composed bot protocols, replaying a
+# synthetic or recorded trace against the loopback IRC server
+#
+# Usage: suite.py [<number of lines> [<recorded trace>]]
+
+import os, sys
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', 'src'))
+
+from pyircbot.core import BotFactory
+from pyircbot.basics import HelpBotProtocol
+from pyircbot.behavior import AliasBotProtocol, FloodControlBotProtocol, LoggingBotProtocol
+from pyircbot.evaluation import ListBulkingBotProtocol, PyBotProtocol
+from pyircbot.permissions import HostPermissionBotProtocol
+from pyircbot.utils import WhoBotProtocol
+from pyircbot.loopback import recorded, replay, synthetic
+
+COMMANDS = [
+	'cat a b c->echo',
+	'cat a b c->map x*2->filter x!="bb"->echo',
+	'py [1,2,3]',
+	'who #bench->echo',
+	'help',
+	'unknown command',
+]
+
+class EvaluationStack (HelpBotProtocol, WhoBotProtocol, ListBulkingBotProtocol, PyBotProtocol):
+	pass
+
+class FullStack (LoggingBotProtocol, HostPermissionBotProtocol, AliasBotProtocol,
+                 HelpBotProtocol, WhoBotProtocol, ListBulkingBotProtocol, PyBotProtocol):
+	pass
+
+class FloodControlledStack (FloodControlBotProtocol, FullStack):
+	pass
+
+STACKS = [EvaluationStack, FullStack, FloodControlledStack]
+
+def factory (stack):
+	factory = BotFactory ('bench', None, ['#bench'], '!', '->')
+	factory.permissions = dict ([(command, ['.*']) for command in stack.commands])
+	factory.aliasdb = ':memory:'
+	factory.sandboxworkers = 0
+	factory.floodrate = 1000
+	factory.floodburst = 1000
+	return factory
+
+if __name__ == '__main__':
+	count = int (sys.argv[1]) if len (sys.argv) > 1 else 20000
+	for stack in STACKS:
+		if len (sys.argv) > 2:
+			trace = recorded (sys.argv[2])
+		else:
+			trace = synthetic (COMMANDS, count = count)
+		stats = replay (stack, factory (stack), trace)
+		stats['stack'] = stack.__name__
+		print ('%(stack)20s: %(lines)6d lines, %(rate)8.0f lines/s, p50 %(p50)8.6fs, p99 %(p99)8.6fs, '
+		       '%(messages)6d messages, %(objects)+6d objects, %(rss)+6dkB' % stats)
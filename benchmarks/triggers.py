@@ -0,0 +1,53 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+#
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Benchmark of passive triggers over channel lines
+# Compares the trigger engine with checking every trigger pattern in turn
+
+import os, sys, re, timeit
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', 'src'))
+
+from pyircbot.triggers import TriggerEngine
+from random import Random
+
+def words (count, seed = 0):
+	random = Random (seed)
+	return [''.join ([random.choice ('abcdefghijklmnopqrstuvwxyz') for i in range (random.randint (4, 9))])
+	        for j in range (count)]
+
+def naive (triggers):
+	compiled = [(re.compile (trigger[1:-1] if trigger[0] == '/' else r'\b%s\b' % re.escape (trigger), re.I), command)
+	            for trigger, command in triggers]
+	return lambda text: [command for pattern, command in compiled if pattern.search (text)]
+
+if __name__ == '__main__':
+	number = int (sys.argv[1]) if len (sys.argv) > 1 else 2000
+	vocabulary = words (5000, 1)
+	random = Random (2)
+	lines = [' '.join ([random.choice (vocabulary) for i in range (12)]) for j in range (number)]
+	for count in (10, 100, 500):
+		keywords = words (count)
+		triggers = [(keyword, 'echo') for keyword in keywords[:count * 9 // 10]]
+		triggers += [('/^%s.*%s/' % (keyword[:3], keyword[-2:]), 'echo') for keyword in keywords[count * 9 // 10:]]
+		before, after = naive (triggers), TriggerEngine (triggers).commands
+		assert [len (before (line)) for line in lines] == [len (after (line)) for line in lines]
+		before = min (timeit.repeat (lambda: [before (line) for line in lines], number = 1, repeat = 3)) / number
+		after = min (timeit.repeat (lambda: [after (line) for line in lines], number = 1, repeat = 3)) / number
+		print '%4d triggers: before %7.2fus, after %7.2fus, speedup x%.1f' % (
+			count, before * 1e6, after * 1e6, before / after)
@@ -17,15 +17,21 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from . import __version__, __website__
-from core import BotProtocol, BotRegister, botcommand
+from core import BotProtocol, botcommand, render
+from metrics import listen
+from reloading import reloadclass
+from twisted.python import log
 from datetime import datetime
 from twisted.internet import reactor
+import re
 
 class DebugBotProtocol(BotProtocol):
 	'''
 	I am a bot protocol which implements a debugging behavior. When debugging
 	is enabled, no command nor message is sent to anyone, but everything is
 	simply printed over the output channel
+	When running under a supervisor, the debug flag and stop command apply
+	to every worker
 	'''
 	def sendmsg (self, out, channel, message):
 		if self.factory.debug:
@@ -49,6 +55,8 @@ class DebugBotProtocol(BotProtocol):
 		'''
 		if not value is None:
 			self.factory.debug = not value == '0'
+			if getattr (self.factory, 'control', None):
+				self.factory.control.send ('debug', value = self.factory.debug)
 		out.append ('Debug is ' + ('enabled' if self.factory.debug else 'disabled'))
 
 	@botcommand
@@ -57,33 +65,41 @@ class DebugBotProtocol(BotProtocol):
 		\x02stop\x02
 		Stops the IRC bot
 		'''
-		reactor.stop ()
+		if getattr (self.factory, 'control', None):
+			self.factory.control.send ('stop')
+		else:
+			reactor.stop ()
 	
 class HelpBotProtocol(BotProtocol):
 	'''
 	I am a bot protocol which implements a help command
 	When an error occures, the help function is called as well
+	
+	Help texts are rendered once, and commands every user may run are
+	cached, so that neither help nor errors check every command again
 	'''
 	def _error (self, error, out, user, channel, command, args):
 		self.help (None, out, user, channel, command)
 		super(HelpBotProtocol, self)._error (error, out, user, channel, command, args)
-		
-	@botcommand
+
+	def _helptext (self, command):
+		if command in self.commands:
+			return self.commands[command].help
+		return render (getattr (self, command).__doc__) or ['No documentation available for %s' % (command,)]
+
+	@botcommand (cache = 300, scope = 'user')
 	def help (self, flow, out, user, channel, command = None, *args):
-		if command and self._check (user, channel, command, args):
-			doc = getattr (self, command).__doc__
-			out += ([line.strip () for line in doc.split ('\n') if not line.strip () == '']
-			        if doc else ['No documentation available for %s' % (command,)])
+		capabilities = self._capabilities (user, channel)
+		if command and command in capabilities:
+			out += self._helptext (command)
 		else:
-			out.append ('\x02Available commands:\x02 ' + ', '.join (
-				[x for x in BotRegister.commands.keys () if self._check (user, channel, x, [])]
-			))
+			out.append ('\x02Available commands:\x02 ' + ', '.join (sorted (capabilities)))
 
 class VersionBotProtocol (BotProtocol):
 	'''
 	I am a bot protocol aware of its imlementation version
 	'''
-	@botcommand
+	@botcommand (cache = 3600)
 	def version (self, flow, out, user, channel):
 		out.append ('\x02Hi, I am a nice PyIRCBot powered robot!')
 		out.append ('Bot version: %s, running since %s' % (self.__version__, str (self._startTime)))
@@ -115,3 +131,93 @@ class ChannelsBotProtocol (BotProtocol):
 		'''
 		for chan in flow:
 			self.leave (chan)
+
+class StatsBotProtocol (BotProtocol):
+	'''
+	I am a bot protocol which reports the metrics collected while running
+	commands. If the factory has a `metricsport`, they are also served in
+	the Prometheus format over HTTP on localhost
+	'''
+	@botcommand
+	def stats (self, flow, out, user, channel, command = None):
+		'''
+		\x02stats\x02 [<command>]
+		Displays calls, errors and latencies of every command
+		If a command is specified, only displays its own statistics
+		'''
+		metrics = self.factory.metrics
+		commands = [command] if command else metrics.labels ('latency_seconds')
+		for name in commands:
+			label = ('command', name)
+			histogram = metrics.histograms.get (('latency_seconds', label))
+			if histogram is None or not histogram.count:
+				out.append ('\x02%s\x02: never called' % name)
+				continue
+			out.append ('\x02%s\x02: %d calls, %d errors, mean %.2fms, p99 under %.2fms' % (
+				name, metrics.counters.get (('calls', label), 0), metrics.counters.get (('errors', label), 0),
+				histogram.sum / histogram.count * 1000, histogram.quantile (0.99) * 1000))
+			queue = metrics.histograms.get (('queue_seconds', label))
+			if queue is not None and queue.count:
+				out[-1] += ', mean queue wait %.2fms' % (queue.sum / queue.count * 1000)
+			hits, misses = metrics.counters.get (('cachehits', label), 0), metrics.counters.get (('cachemisses', label), 0)
+			if hits + misses:
+				out[-1] += ', %d%% cache hits' % (100 * hits // (hits + misses))
+		if not command:
+			out.append ('%d messages, %d denied' % (
+				metrics.counters.get (('messages', None), 0), metrics.counters.get (('denied', None), 0)))
+
+	@botcommand
+	def flush (self, flow, out, user, channel, command = None):
+		'''
+		\x02flush\x02 [<command>]
+		Flushes the cached results of every command, or of the given one
+		'''
+		results = self.factory.results
+		for key in results.keys ():
+			if command is None or key[0] == command:
+				del results[key]
+		out.append ('Flushed cached results' + (' of %s' % command if command else ''))
+
+	def connectionMade (self):
+		port = getattr (self.factory, 'metricsport', None)
+		if port and getattr (self.factory, '_metricslistener', None) is None:
+			self.factory._metricslistener = listen (self.factory.metrics, port)
+		super (StatsBotProtocol, self).connectionMade ()
+
+class ReloadBotProtocol (BotProtocol):
+	'''
+	I am a bot protocol able to reload its code without reconnecting: the
+	pyircbot modules and the modules of my classes are reloaded, then my
+	class and the factory class are rebuilt from them and replace the
+	current ones, every attribute of the connection being kept. Mixins may
+	extend `_reloaded` to adapt their state. If any module fails to load,
+	the code in use is kept as is.
+	
+	Only users whose hostmask matches one of the factory `reloaders`
+	regular expressions may reload the code, nobody by default
+	'''
+	def _check (self, user, channel, command, args):
+		if command == 'reload' and not any ([re.match (pattern, user)
+		                                     for pattern in getattr (self.factory, 'reloaders', ())]):
+			return False
+		return super(ReloadBotProtocol, self)._check (user, channel, command, args)
+
+	@botcommand
+	def reload (self, flow, out, user, channel):
+		'''
+		\x02reload\x02
+		Reloads the bot code without reconnecting
+		'''
+		try:
+			(cls, factory), names = reloadclass (self.__class__, self.factory.__class__)
+		except Exception as error:
+			log.err (None, 'reload failed')
+			out.append ('\x02Error\x02: reload failed, %s' % error)
+			return
+		if self.factory.protocol is self.__class__:
+			self.factory.protocol = cls
+		self.factory.__class__ = factory
+		self.__class__ = cls
+		self.factory.invalidate ()
+		self._reloaded ()
+		out.append ('Reloaded %d modules, %d commands available' % (len (names), len (cls.commands)))
@@ -17,29 +17,179 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from core import BotProtocol, botcommand
-from twisted.internet.defer import Deferred
+from scheduler import OutboundScheduler, TokenBucket
+from store import SQLiteAliasStore
+from logsink import LogSink
+from cache import LRUCache
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, TimeoutError
 from twisted.internet.task import LoopingCall
 from twisted.python import log
+from collections import deque
+from glob import glob
+from math import ceil
 import shelve
-import new
 
 class LoggingBotProtocol(BotProtocol):
 	'''
 	I am a bot protocol which is able to log commands and messages to
 	a file-like object.
+	
+	If the factory has a `logpath`, records are rather queued to a
+	structured `LogSink` shared by the factory connections, configured by
+	`logformat`, `logqueue`, `logpolicy`, `logbatch`, `logrotate` and
+	`logkeep`; dropped records are counted in the factory metrics
 	'''
+	def connectionMade (self):
+		self._sink = getattr (self.factory, '_logsink', None)
+		if self._sink is None and getattr (self.factory, 'logpath', None):
+			self._sink = LogSink (self.factory.logpath,
+				getattr (self.factory, 'logformat', 'json'),
+				getattr (self.factory, 'logqueue', 10000),
+				getattr (self.factory, 'logpolicy', 'drop'),
+				getattr (self.factory, 'logbatch', 500),
+				rotate = getattr (self.factory, 'logrotate', 1 << 20),
+				keep = getattr (self.factory, 'logkeep', 10))
+			reactor.addSystemEventTrigger ('before', 'shutdown', self._sink.close)
+			self.factory._logsink = self._sink
+		super (LoggingBotProtocol, self).connectionMade ()
+
+	def _log (self, event, *values):
+		if self._sink is None:
+			log.msg ('%s %s' % (event, ' '.join (values)))
+		elif not self._sink.put (event, *values):
+			self.factory.metrics.count ('logdropped')
+
 	def privmsg (self, user, channel, message):
-		log.msg ('incoming %s %s %s' % (user, channel, message))
+		self._log ('incoming', user, channel, message)
 		super (LoggingBotProtocol, self).privmsg (user, channel, message)
 
 	def msg (self, channel, message):
-		log.msg ('outgoing %s %s' % (channel, message))
+		self._log ('outgoing', channel, message)
 		super (LoggingBotProtocol, self).msg (channel, message)
 
 	def command (self, out, command, *args):
-		log.msg ('command %s %s' % (command, ' '.join (args)))
+		self._log ('command', command, ' '.join (args))
 		super (LoggingBotProtocol, self).command (out, command, *args)
 
+class FloodControlBotProtocol(BotProtocol):
+	'''
+	I am a bot protocol which schedules every outgoing line so that the
+	robot never floods the server. Lines are sent at `floodrate` lines per
+	second with bursts of up to `floodburst` lines, both read from the
+	factory.
+	
+	PONG and QUIT lines are always sent first, so that the server never
+	times the robot out, then any other protocol traffic (JOIN, WHO, MODE,
+	etc.), while messages and notices are queued per target and served in
+	turn, so a long output to one channel does not hold up replies to the
+	others. A `floodrate` of 0 disables flood control
+	'''
+	urgent = ('PONG', 'QUIT')
+
+	def connectionMade (self):
+		'''
+		Initialization of specific attributes
+		'''
+		self._outbound = OutboundScheduler (self._write,
+			getattr (self.factory, 'floodrate', 1),
+			getattr (self.factory, 'floodburst', 5),
+			getattr (self.factory, 'clock', reactor))
+		super(FloodControlBotProtocol, self).connectionMade ()
+
+	def connectionLost (self, reason):
+		self._outbound.stop ()
+		super(FloodControlBotProtocol, self).connectionLost (reason)
+
+	def _write (self, line):
+		super(FloodControlBotProtocol, self).sendLine (line)
+
+	def sendLine (self, line):
+		command, rest = (line.split (' ', 1) + [''])[:2]
+		command = command.upper ()
+		if command in ('PRIVMSG', 'NOTICE'):
+			self._outbound.push (line, rest.split (' ', 1)[0].lower ())
+		else:
+			self._outbound.push (line, urgent = command in self.urgent)
+
+	@botcommand
+	def queue (self, flow, out, user, channel):
+		'''
+		\x02queue\x02
+		Displays the outbound queue depth and waiting times
+		'''
+		stats = self._outbound.stats ()
+		out.append ('\x02Queue:\x02 %(depth)d lines (%(urgent)d urgent, %(protocol)d protocol) for %(targets)d targets, '
+		            'oldest %(oldest).1fs' % stats)
+		out.append ('\x02Sent:\x02 %(sent)d lines, mean wait %(meanwait).2fs, max wait %(maxwait).2fs' % stats)
+
+class AdmissionBotProtocol(BotProtocol):
+	'''
+	I am a bot protocol which refuses commands from users running too many
+	of them. Every hostmask has a token bucket refilled with `admissionrate`
+	tokens per second, up to `admissionburst`; every command costs its
+	weight from `admissioncosts`, 1 by default, and every piped stage
+	`admissionpipe` more, at most the whole burst. Buckets are kept for
+	the `admissionusers` most recent hostmasks only, all read from the
+	factory. Messages from the factory `sync` actors are always admitted.
+	
+	Refused messages are counted in the factory metrics by command, lines
+	not starting with a known command or alias all as 'unknown', and if the
+	factory `admissionnotice` is set, users are told with a notice, at
+	most once every `admissionnotice` seconds
+	'''
+	costs = {'mass': 10, 'py': 5, 'grep': 3}
+
+	def _admission (self):
+		'''
+		Returns the buckets table shared by the factory connections
+		'''
+		if getattr (self.factory, '_admission', None) is None:
+			self.factory._admission = LRUCache (getattr (self.factory, 'admissionusers', 4096))
+		return self.factory._admission
+
+	def _admit (self, user, channel, message):
+		if channel in getattr (self.factory, 'sync', ()):
+			# replies from the actors I am talking to are never charged
+			return super(AdmissionBotProtocol, self)._admit (user, channel, message)
+		burst = getattr (self.factory, 'admissionburst', 10)
+		command = message.split (self.factory.pipe, 1)[0].split (' ', 1)[0]
+		if command in self._candidates ():
+			stages = self._plan (message).stages
+			costs = getattr (self.factory, 'admissioncosts', self.costs)
+			cost = min (burst, sum ([costs.get (name, 1) for name, args in stages]) +
+			                   (len (stages) - 1) * getattr (self.factory, 'admissionpipe', 1))
+		else: # no plan for junk, it costs the default weight
+			command, cost = 'unknown', 1
+		admission = self._admission ()
+		entry = admission.get (user)
+		if entry is None:
+			bucket = TokenBucket (getattr (self.factory, 'admissionrate', 1), burst, self.factory.clock.seconds)
+			entry = admission[user] = [bucket, None]
+		if not entry[0].consume (cost):
+			self.factory.metrics.count ('rejected', ('command', command))
+			self._refused (user, entry, cost)
+			return False
+		return super(AdmissionBotProtocol, self)._admit (user, channel, message)
+
+	def _refused (self, user, entry, cost):
+		interval = getattr (self.factory, 'admissionnotice', None)
+		now = self.factory.clock.seconds ()
+		if interval and (entry[1] is None or now - entry[1] >= interval):
+			entry[1] = now
+			self.notice (user.split ('!')[0], 'Too many commands, please wait %d seconds' % max (1, ceil (entry[0].delay (cost))))
+
+class AsynchronousJob (object):
+	'''
+	I am a request pending for an actor
+	'''
+	def __init__ (self, message, deferred, queued):
+		self.message = message
+		self.deferred = deferred
+		self.queued = queued
+		self.sent = None
+		self.timeout = None
+
 class AsynchronousCallBotProtocol(BotProtocol):
 	'''
 	I am a bot protocol which implements asynchronous queries to other bots
@@ -49,84 +199,241 @@ class AsynchronousCallBotProtocol(BotProtocol):
 	
 	For instance, if one service called DummyServ replies 'Pong!' to the
 	message 'ping', just add {'DummyServ': ('ping', 'Pong!')} to your factory
-	and I will be able to interact with it (him).
+	and I will be able to interact with it (him). If the actor is able to
+	handle several queries at once, you may add how many to the handshake,
+	like ('ping', 'Pong!', 4); replies are expected in order.
 	
 	I maintain a pool of pending requests for every actor. When an actor is
 	finished talking, I simply fires your callback and execute the next
-	pending request.
+	pending request. Requests failing to complete within `synctimeout`
+	seconds fail with a TimeoutError, and at most `syncbuffer` lines are
+	kept for a single reply. Late replies to a request which expired or was
+	cancelled while running are discarded, up to their end message.
 	'''
 	def _sync (self, user, channel, message):
 		'''
 		This is called when a message is recieve from one of the actors
 		I am connected to
 		'''
-		if self._job[channel]:
-			query, stop = self.factory.sync[channel]
+		if self._jobs[channel]:
+			stop = self.factory.sync[channel][1]
 			if not message == stop:
-				self._buffer[channel].append (message)
+				if self._jobs[channel][0] is None:
+					pass # late reply to a dropped job
+				elif len (self._replies[channel]) < self._buffersize:
+					self._replies[channel].append (message)
+				else:
+					self._counters[channel]['dropped'] += 1
+			elif self._jobs[channel][0] is None:
+				self._jobs[channel].popleft ()
 			else:
-				self._job[channel].callback (self._buffer[channel])
-				self._buffer[channel] = []
-				self._nextjob (channel)				
-			
+				job = self._jobs[channel].popleft ()
+				result = self._replies[channel]
+				self._replies[channel] = []
+				self._done (channel, job, 'completed')
+				latency = self._clock.seconds () - job.sent
+				counters = self._counters[channel]
+				counters['latency'] += latency
+				counters['maxlatency'] = max (counters['maxlatency'], latency)
+				job.deferred.callback (result)
+				self._nextjob (channel)
+
 	def _nextjob (self, channel):
 		'''
-		This is called to trigger the next job in the pool if available
+		This is called to trigger the next jobs in the pool if available
 		'''
-		if len(self._pool[channel]) > 0:
-			query, stop = self.factory.sync[channel]
-			d, message = self._pool[channel].pop (0)
-			self.msg (channel, message)
+		query, stop = self.factory.sync[channel][:2]
+		depth = (self.factory.sync[channel][2:] or (1,))[0]
+		while self._pool[channel] and self._running (channel) < depth:
+			job = self._pool[channel].popleft ()
+			self.msg (channel, job.message)
 			for line in query:
 				self.msg (channel, line)
-			self._buffer[channel] = []
-			self._job[channel] = d
-		else:
-			self._job[channel] = None
+			job.sent = self._clock.seconds ()
+			self._jobs[channel].append (job)
+
+	def _running (self, channel):
+		'''
+		Returns the number of jobs running, dropped ones left apart
+		'''
+		return len (self._jobs[channel]) - list (self._jobs[channel]).count (None)
 
 	def _addjob (self, channel, message):
 		'''
 		You might use this method to add a new request message for the
-		actor channel, just rely on the returned deferred
+		actor channel, just rely on the returned deferred, which might be
+		cancelled
+		'''
+		job = AsynchronousJob (message, Deferred (lambda d: self._cancel (channel, job)),
+		                       self._clock.seconds ())
+		job.timeout = self._clock.callLater (getattr (self.factory, 'synctimeout', 60),
+		                                     self._expire, channel, job)
+		self._pool[channel].append (job)
+		self._nextjob (channel)
+		return job.deferred
+
+	def _drop (self, channel, job):
+		'''
+		Removes a job, either pending or running, then triggers the next ones
+		A running job is replaced with None until its end message is
+		received, so that its late replies are not mistaken for the next job
+		ones
 		'''
-		d = Deferred ()
-		self._pool[channel].append ((d, message))
-		if not self._job[channel]:
+		if job in self._pool[channel]:
+			self._pool[channel].remove (job)
+		elif job in self._jobs[channel]:
+			if self._jobs[channel][0] is job:
+				self._replies[channel] = []
+			self._jobs[channel][list (self._jobs[channel]).index (job)] = None
 			self._nextjob (channel)
-		return d
-		
+
+	def _done (self, channel, job, counter):
+		if job.timeout and job.timeout.active ():
+			job.timeout.cancel ()
+		job.timeout = None
+		self._counters[channel][counter] += 1
+
+	def _expire (self, channel, job):
+		job.timeout = None
+		self._drop (channel, job)
+		self._done (channel, job, 'expired')
+		job.deferred.errback (TimeoutError ('%s did not reply to %s' % (channel, job.message)))
+
+	def _cancel (self, channel, job):
+		self._drop (channel, job)
+		self._done (channel, job, 'cancelled')
+
+	def _syncstats (self, channel):
+		'''
+		Returns counters about the given actor, including the current queue
+		length and mean round-trip latency
+		'''
+		stats = dict (self._counters[channel])
+		stats['queued'] = len (self._pool[channel])
+		stats['running'] = self._running (channel)
+		stats['meanlatency'] = stats['latency'] / stats['completed'] if stats['completed'] else 0.0
+		return stats
+
+	@botcommand
+	def actors (self, flow, out, user, channel):
+		'''
+		\x02actors\x02
+		Displays the queues and latencies of the actors I am talking to
+		'''
+		for actor in self.factory.sync:
+			stats = self._syncstats (actor)
+			stats['actor'] = actor
+			out.append ('\x02%(actor)s:\x02 %(queued)d queued, %(running)d running, '
+			            '%(completed)d completed, %(expired)d expired, '
+			            'latency %(meanlatency).2fs (max %(maxlatency).2fs)' % stats)
+
 	def connectionMade (self):
 		'''
 		Initialization of specific attributes
 		'''
-		self._pool = dict([(key, []) for key in self.factory.sync])
-		self._job = dict([(key, None) for key in self.factory.sync])
-		self._buffer = dict([(key, []) for key in self.factory.sync])
+		self._clock = getattr (self.factory, 'clock', reactor)
+		self._buffersize = getattr (self.factory, 'syncbuffer', 1000)
+		self._pool = dict([(key, deque ()) for key in self.factory.sync])
+		self._jobs = dict([(key, deque ()) for key in self.factory.sync])
+		self._replies = dict([(key, []) for key in self.factory.sync])
+		self._counters = dict([(key, dict (completed = 0, expired = 0, cancelled = 0, dropped = 0,
+		                                   latency = 0.0, maxlatency = 0.0))
+		                       for key in self.factory.sync])
 		super(AsynchronousCallBotProtocol, self).connectionMade ()
 
-	def _handle (self, user, channel, message, wrap = False):
+	def connectionLost (self, reason):
+		'''
+		Every pending job fails when the connection is lost
+		'''
+		for channel in self._pool:
+			jobs = [job for job in self._jobs[channel] if job is not None] + list (self._pool[channel])
+			self._jobs[channel].clear ()
+			self._pool[channel].clear ()
+			for job in jobs:
+				self._done (channel, job, 'cancelled')
+				job.deferred.errback (reason)
+		super(AsynchronousCallBotProtocol, self).connectionLost (reason)
+
+	def _handle (self, user, channel, message, wrap = False, alive = None):
 		'''
 		Triggers the _sync method if necessary
 		'''
 		if channel in self.factory.sync:
 			self._sync (user, channel, message)
-		return super(AsynchronousCallBotProtocol, self)._handle (user, channel, message, wrap)
+		return super(AsynchronousCallBotProtocol, self)._handle (user, channel, message, wrap, alive)
+
+class Alias (object):
+	'''
+	I am a compiled alias: I know the commands my template refers to and I
+	cache my expansions, so that they hit the compiled pipelines cache
+	'''
+	expansions = 64
+
+	def __init__ (self, name, template):
+		self.name = name
+		self.template = template
+		self.commands = []
+		for words in [x.split (' ') for x in template.split ('->')]:
+			self.commands.append (words[0])
+			if words[0] == 'mass' and len (words) > 1:
+				self.commands.append (words[1])
+		self._expansions = LRUCache (Alias.expansions)
+
+	def expand (self, args):
+		'''
+		Returns the command line for the given arguments
+		'''
+		text = self._expansions.get (args)
+		if text is None:
+			text = self.template % dict (zip (map (str, range (len (args))), args))
+			self._expansions[args] = text
+		return text
 
 class AliasBotProtocol (BotProtocol):
 	'''
 	I am a bot protocol which implement command aliases
+	
+	Aliases are kept in the factory `aliasstore`, by default a SQLite
+	database named after the factory `aliasdb`; changed aliases are written
+	every `aliassync` seconds
+	
+	Aliases calling each other in a loop are refused, as well as aliases
+	nesting more than `aliasdepth` levels or expanding to more than
+	`aliascost` commands
 	'''
+	def _store (self):
+		'''
+		Returns the alias store shared by every connection of the factory,
+		opening the default one if none was provided
+		'''
+		store = getattr (self.factory, 'aliasstore', None)
+		if store is None:
+			store = SQLiteAliasStore (getattr (self.factory, 'aliasdb', 'aliases.sqlite'))
+			if not len (store) and glob ('aliases.db*'): # former shelve store
+				legacy = shelve.open ('aliases.db', flag = 'r')
+				store.update (legacy)
+				legacy.close ()
+			reactor.addSystemEventTrigger ('before', 'shutdown', store.close)
+			self.factory.aliasstore = store
+		return store
+
 	def connectionMade (self):
 		'''
 		Initialization of specific attributes
 		'''
-		self._aliases = {}
-		self._aliases = shelve.open('aliases.db', flag='c', protocol=None, 
-					    writeback=True)
-		loop = LoopingCall (self._aliases.sync)
-		loop.start (10)
+		self._aliases = self._store ()
+		self._compiled = {}
+		self._compiledgeneration = self.factory.generation
+		self._aliasdepth = 0
+		self._aliasloop = LoopingCall (self._aliases.sync)
+		self._aliasloop.start (getattr (self.factory, 'aliassync', 10), now = False)
 		super(AliasBotProtocol, self).connectionMade ()
 
+	def connectionLost (self, reason):
+		self._aliasloop.stop ()
+		self._aliases.sync ()
+		super(AliasBotProtocol, self).connectionLost (reason)
+
 	@botcommand
 	def setAlias (self, flow, out, user, channel, name, *command):
 		'''
@@ -138,9 +445,22 @@ class AliasBotProtocol (BotProtocol):
 		'''
 		if name in dir (self) or name.startswith ('_'):
 			out.append ('\x02Error\x02: illegal alias name')
+			return
+		command = ' '.join (command).replace ('=>', '->')
+		alias = Alias (name, command)
+		lookup = lambda command: alias if command == name else self._alias (command)
+		try:
+			depth, cost = self._measure (alias, lookup)
+		except ValueError as error:
+			out.append ('\x02Error\x02: %s' % error)
+			return
+		if depth > getattr (self.factory, 'aliasdepth', 8):
+			out.append ('\x02Error\x02: aliases nested %d levels deep' % depth)
+		elif cost > getattr (self.factory, 'aliascost', 64):
+			out.append ('\x02Error\x02: alias expanding to %d commands' % cost)
 		else:
-			command = ' '.join (command).replace ('=>', '->')
 			self._aliases[name] = command
+			self.factory.invalidate ()
 			out.append ('\x02Saved %s as\x02: %s' % (name, command))
 
 	@botcommand
@@ -164,16 +484,66 @@ class AliasBotProtocol (BotProtocol):
 			out.append ('\x02Warning\x02 Unkown alias %s' % name)
 		out.append ('Deleted alias \x02%s\x02' % name)
 		del self._aliases[name]
+		self.factory.invalidate ()
 
 	def _check (self, user, channel, command, args):
 		return (super(AliasBotProtocol, self)._check (user, channel, command, args)
 			or command in self._aliases)
+
+	def _candidates (self):
+		return super(AliasBotProtocol, self)._candidates () + self._aliases.keys ()
 	
+	def _alias (self, name):
+		'''
+		Returns the compiled alias for the given name, None if no such alias
+		is defined, along with its bound handler
+		'''
+		if not self._compiledgeneration == self.factory.generation:
+			self._compiled.clear ()
+			self._compiledgeneration = self.factory.generation
+		if name not in self._compiled:
+			if name not in self._aliases:
+				return None
+			alias = Alias (name, self._aliases[name])
+			handler = lambda flow, out, user, channel, *args: self._expand (alias, flow, user, channel, args)
+			handler.__doc__ = '\x02%s\x02: alias for %s' % (name, alias.template)
+			self._compiled[name] = (alias, handler)
+		return self._compiled[name][0]
+
+	def _measure (self, alias, lookup, path = ()):
+		'''
+		Returns the nesting depth of the given alias and the number of
+		commands it expands to, raises ValueError if aliases loop
+		'''
+		path = path + (alias.name,)
+		depth, cost = 0, 0
+		for command in alias.commands:
+			if command in path:
+				raise ValueError ('aliases loop through %s' % ' -> '.join (path + (command,)))
+			target = lookup (command)
+			if target is None:
+				cost += 1
+			else:
+				subdepth, subcost = self._measure (target, lookup, path)
+				depth = max (depth, subdepth)
+				cost += subcost
+		return depth + 1, cost
+
+	def _expand (self, alias, flow, user, channel, args):
+		'''
+		Runs the expansion of an alias on the given flow
+		'''
+		if self._aliasdepth >= getattr (self.factory, 'aliasdepth', 8):
+			raise RuntimeError ('alias %s nested too deep' % alias.name)
+		self._aliasdepth += 1
+		try:
+			d = self._handle (user, channel, alias.expand (args), True)
+			d.callback (flow)
+		finally:
+			self._aliasdepth -= 1
+		return d
+
 	def __getattr__ (self, name):
-		if name in self._aliases:
-			def f (self, flow, out, user, channel, *args):
-				args = dict (zip (map (str, range (len (args))), args))
-				d = self._handle (user, channel, self._aliases[name] % args, True)
-				d.callback (flow)
-				return d
-			return new.instancemethod (f, self, self.__class__)
+		if not name.startswith ('_') and self._alias (name) is not None:
+			return self._compiled[name][1]
+		raise AttributeError (name)
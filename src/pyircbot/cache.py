@@ -0,0 +1,70 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import OrderedDict
+
+class LRUCache (object):
+	'''
+	I am a size-bounded mapping: when I am full, the least recently used
+	entries are forgotten first
+	'''
+	def __init__ (self, size):
+		self.size = size
+		self._data = OrderedDict ()
+
+	def get (self, key, default = None):
+		'''
+		Returns the value for the given key and marks it as recently used
+		'''
+		try:
+			value = self._data.pop (key)
+		except KeyError:
+			return default
+		self._data[key] = value
+		return value
+
+	def pop (self, key, default = None):
+		return self._data.pop (key, default)
+
+	def clear (self):
+		self._data.clear ()
+
+	def keys (self):
+		return self._data.keys ()
+
+	def __setitem__ (self, key, value):
+		self._data.pop (key, None)
+		self._data[key] = value
+		while len (self._data) > self.size:
+			self._data.popitem (last = False)
+
+	def __getitem__ (self, key):
+		value = self.get (key, self)
+		if value is self:
+			raise KeyError (key)
+		return value
+
+	def __delitem__ (self, key):
+		del self._data[key]
+
+	def __contains__ (self, key):
+		return key in self._data
+
+	def __len__ (self):
+		return len (self._data)
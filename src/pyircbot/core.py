@@ -16,24 +16,181 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from twisted.words.protocols.irc import IRCClient
-from twisted.internet.protocol import ClientFactory
-from twisted.internet.defer import Deferred
+from twisted.words.protocols.irc import IRCClient, CHANNEL_PREFIXES
+from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
 from twisted.python import log
+from twisted.python.failure import Failure
+from cache import LRUCache
+from metrics import Metrics
+from inspect import getargspec
+from itertools import chain, islice
+from time import time
 
 class BotRegister(object):
 	'''
-	I am the command register
+	I am the global command register, kept for compatibility only: every
+	protocol class has its own `commands` dispatch table
 	'''
 	commands = {}
 
-def botcommand (function):
+def botcommand (function = None, **options):
 	'''
-	I'm a Python decorator updating the commands register
+	I'm a Python decorator marking bot commands and updating the commands
+	register, either used as is or with options:
+	
+		@botcommand (cache = 60, scope = 'user')
+	
+	`cache` is the number of seconds the output and result of the command
+	are kept for the same arguments and input flow, `scope` tells whether
+	they are shared by every 'user', in every 'channel', or only for the
+	same 'user' in the same channel.
+	
+	`blocking` commands run in the factory thread pool, at most
+	`concurrency` of them at once; they shall not use the protocol but to
+	fill their output
 	'''
+	if function is None:
+		return lambda function: botcommand (function, **options)
+	function.botcommand = True
+	function.botoptions = options
+	function.botfunction = function # kept through wrapping decorators
 	BotRegister.commands[function.__name__] = function
 	return function
 
+def render (doc):
+	'''
+	Renders a docstring as help lines
+	'''
+	return [line.strip () for line in (doc or '').split ('\n') if line.strip ()]
+
+class BotCommand (object):
+	'''
+	I am an entry of a dispatch table: a command name, its function and the
+	number of arguments it accepts, read from the function as marked by
+	`botcommand` even if it was wrapped by another decorator afterwards
+	'''
+	def __init__ (self, name, function):
+		self.name = name
+		self.function = function
+		spec = getargspec (getattr (function, 'botfunction', function))
+		count = len (spec.args) - 5 # self, flow, out, user, channel
+		self.minimum = max (0, count - len (spec.defaults or ()))
+		self.maximum = None if spec.varargs else count
+		self.help = render (function.__doc__) or ['No documentation available for %s' % name]
+		options = getattr (function, 'botoptions', {})
+		self.cache = options.get ('cache')
+		self.scope = options.get ('scope', 'global')
+		self.blocking = options.get ('blocking', False)
+		self.concurrency = options.get ('concurrency')
+
+	def accepts (self, count):
+		return self.minimum <= count and (self.maximum is None or count <= self.maximum)
+
+	def usage (self):
+		if self.maximum is None:
+			expected = 'at least %d' % self.minimum
+		elif self.minimum == self.maximum:
+			expected = '%d' % self.minimum
+		else:
+			expected = '%d to %d' % (self.minimum, self.maximum)
+		return '%s takes %s argument%s' % (self.name, expected, '' if expected == '1' else 's')
+
+class BotType (type):
+	'''
+	I am the metaclass of bot protocols: I build the dispatch table of
+	every protocol class once, when it is created, from the commands
+	marked in the class and its bases
+	
+	The table only tells which commands exist and their arity: every other
+	check depends on the factory settings or on the user, so it is left to
+	`_check`, whose results are cached by the compiled plans
+	'''
+	def __init__ (cls, name, bases, attrs):
+		super(BotType, cls).__init__ (name, bases, attrs)
+		names = set ()
+		for base in cls.__mro__:
+			names.update ([key for key, value in vars (base).items () if getattr (value, 'botcommand', False)])
+		cls.commands = dict ([(name, BotCommand (name, getattr (cls, name))) for name in names])
+
+_pulling = [] # time spent by nested pulls, flows are only pulled by the reactor thread
+
+def timed (flow, metrics, label, elapsed):
+	'''
+	Yields the items of a lazy flow returned by a command, adding the time
+	spent pulling them, but in upstream lazy flows, to the command latency
+	recorded once the flow is exhausted, failed or dropped
+	'''
+	try:
+		while True:
+			start = time ()
+			_pulling.append (0.0)
+			try:
+				item = flow.next ()
+			except StopIteration:
+				return
+			except:
+				metrics.count ('errors', label)
+				raise
+			finally:
+				spent = time () - start
+				elapsed += spent - _pulling.pop ()
+				if _pulling:
+					_pulling[-1] += spent
+			yield item
+	finally:
+		metrics.observe ('latency_seconds', label, elapsed)
+
+def iterflow (flow):
+	'''
+	Returns an iterator over the items of a flow: lists, tuples and
+	iterators are flows, any other value is considered as an empty flow
+	'''
+	if isinstance (flow, (list, tuple)) or hasattr (flow, 'next'):
+		return iter (flow)
+	return iter (())
+
+class FlowLine (object):
+	'''
+	I am an output line displaying a flow. Items are only pulled from the
+	flow when I am rendered, and only as many as fit in the line
+	'''
+	def __init__ (self, prefix, flow, separator = ', '):
+		self.prefix = prefix
+		self.flow = flow
+		self.separator = separator
+
+	def render (self, length):
+		parts = [self.prefix]
+		length -= len (self.prefix)
+		for item in iterflow (self.flow):
+			item = str (item) if len (parts) == 1 else self.separator + str (item)
+			if len (item) > length:
+				parts.append (self.separator + '...' if len (parts) > 1 else '...')
+				break
+			parts.append (item)
+			length -= len (item)
+		return ''.join (parts)
+
+class BotPlan (object):
+	'''
+	I am a compiled command pipeline: I hold the parsed stages of a message,
+	the callables handling every stage once they are resolved and the
+	results of the permission checks for the users who already ran me
+	'''
+	permits = 32
+
+	def __init__ (self, message):
+		commands = message.split('->') # separates the commands
+		commands = [x.split(' ') for x in commands] # splitting
+		self.stages = [(words[0], words[1:]) for words in commands]
+		self.functions = None
+		self.usage = None
+		self.permits = LRUCache (BotPlan.permits)
+
 class BotProtocol (IRCClient, object):
 	'''
 	I'm a generic and dynamic irc bot protocol
@@ -48,15 +205,20 @@ class BotProtocol (IRCClient, object):
 		
 	*args will receive the remaining arguments from the call line on IRC
 	If the command fails or raises an exception, nothing will happen
+	
+	Commands of every protocol class are listed in its `commands` table,
+	and calls with a wrong number of arguments are refused before running
 	'''
+	__metaclass__ = BotType
 	
-	# Here are simply a couple of properties
+	# Here are simply a couple of properties, the factory nickname is the
+	# one we want while ours is the one we actually got
 	@property
 	def nickname (self):
-		return self.factory.nickname
+		return getattr (self, '_nickname', None) or self.factory.nickname
 	@nickname.setter
 	def nickname (self, new):
-		self.factory.nickname = new
+		self._nickname = new
 	@property
 	def password (self):
 		return self.factory.password
@@ -64,9 +226,9 @@ class BotProtocol (IRCClient, object):
 	def _check (self, user, channel, command, args):
 		'''
 		Checks that a command exists and is ok to run
-		Default behavior only queries the register for the given command
+		Default behavior only queries the dispatch table for the given command
 		'''
-		return command in BotRegister.commands
+		return command in self.commands
 
 	def _setup (self, flow, out, user, channel, command, args):
 		'''
@@ -77,9 +239,18 @@ class BotProtocol (IRCClient, object):
 	def _teardown (self, flow, out, user, channel, command, args):
 		'''
 		Called when the handling chain ends, usually to display the
-		message
+		message; flows displayed in the output are only pulled now
 		'''
-		for line in out:
+		lines = []
+		try:
+			for line in out:
+				lines.append (line.render (self.factory.outputlength)
+				              if isinstance (line, FlowLine) else line)
+		except Exception:
+			errors = []
+			self._error (Failure (), errors, user, channel, command, args)
+			lines += errors
+		for line in lines:
 			self.msg (channel, line)
 		return flow
 
@@ -89,36 +260,317 @@ class BotProtocol (IRCClient, object):
 		'''
 		log.err (error)
 
-	def _handle (self, user, channel, message, wrap = False):
+	def _refresh (self):
+		'''
+		Drops compiled plans and cached capabilities once the factory is
+		invalidated, override me to detect other changes
+		'''
+		if not self._generation == self.factory.generation:
+			self._plans.clear ()
+			self._capabilitycache.clear ()
+			self._generation = self.factory.generation
+
+	def _reloaded (self):
+		'''
+		Called once my class was replaced by a reloaded one, binds the
+		command handlers again
+		'''
+		self._handlers = dict ([(name, getattr (self, name)) for name in self.commands])
+
+	def _admit (self, user, channel, message):
+		'''
+		Decides whether a message from the user is handled at all, every
+		message is by default
+		'''
+		return True
+
+	def _candidates (self):
+		'''
+		Returns the names of every command a user might be allowed to run
+		'''
+		return self.commands.keys ()
+
+	def _capabilities (self, user, channel):
+		'''
+		Returns the set of commands the user may run on the channel, cached
+		by nickname until the factory is invalidated or the user leaves or
+		changes nickname
+		'''
+		self._refresh ()
+		nick = user.split ('!')[0].lower ()
+		entries = self._capabilitycache.get (nick)
+		if entries is None:
+			entries = self._capabilitycache[nick] = {}
+		capabilities = entries.get ((user, channel))
+		if capabilities is None:
+			capabilities = frozenset ([command for command in self._candidates ()
+			                           if self._check (user, channel, command, [])])
+			entries[(user, channel)] = capabilities
+		return capabilities
+
+	def _plan (self, message):
+		'''
+		Returns the compiled pipeline plan for the given message, plans are
+		cached until the factory is invalidated
+		'''
+		self._refresh ()
+		plan = self._plans.get (message)
+		if plan is None:
+			plan = BotPlan (message)
+			self._plans[message] = plan
+		return plan
+
+	def _handle (self, user, channel, message, wrap = False, alive = None):
 		'''
 		Handles a message sent directly to the robot
+		If given, `alive` is called once the chain ends and its output is
+		only displayed if it returns True
 		'''
-		commands = message.split('->') # separates the commands
-		commands = [x.split(' ') for x in commands] # splitting
-		commands = [(words[0], words[1:]) for words in commands]
+		plan = self._plan (message)
+		commands = plan.stages
 
 		d = Deferred()
-		if not all([self._check (user, channel, command, args) for command, args in commands]):
+		metrics = self.factory.metrics
+		metrics.count ('messages')
+		permit = plan.permits.get ((user, channel))
+		if permit is None:
+			start = time ()
+			permit = all([self._check (user, channel, command, args) for command, args in commands])
+			metrics.observe ('check_seconds', None, time () - start)
+			plan.permits[(user, channel)] = permit
+		if not permit:
+			metrics.count ('denied')
+			return d
+		if plan.functions is None: # resolving every command once
+			plan.functions = [self._handlers.get (command) or getattr (self, command) for command, args in commands]
+			plan.usage = [(command, args, self.commands[command].usage ()) for command, args in commands
+			              if command in self.commands and not self.commands[command].accepts (len (args))]
+		if plan.usage:
+			command, args, usage = plan.usage[0]
+			errors = ['\x02Error\x02: %s' % usage]
+			self._error (Failure (TypeError (usage)), errors, user, channel, command, args)
+			for line in errors:
+				self.msg (channel, line)
 			return d
 		if wrap:
 			command, args = commands[0] # first command, setting up
 			d.addCallback(self._setup, [], user, channel, command, args)
-		for command, args in commands: # chaining every command
+		for function, (command, args) in zip (plan.functions, commands): # chaining every command
 			out = []
-			function = getattr (self, command)
-			d.addCallback(function, out, user, channel, *args)
+			d.addCallback(self._stage, function, command, out, user, channel, *args)
 			d.addErrback(self._error, out, user, channel, command, args)
 		if wrap:
 			command, args = commands[-1] # tearing down
-			d.addCallback(self._teardown, out, user, channel, command, args)
+			if alive is None:
+				d.addCallback(self._teardown, out, user, channel, command, args)
+			else:
+				d.addCallback(lambda flow: self._teardown (flow, out, user, channel, command, args)
+				              if alive () else flow)
 		return d
 
+	def _stage (self, flow, function, command, out, user, channel, *args):
+		'''
+		Runs a single command of a pipeline, from the results cache if the
+		command allows it
+		'''
+		spec = self.commands.get (command)
+		if spec is not None and spec.cache:
+			return self._cached (spec, flow, function, out, user, channel, args)
+		return self._run (flow, function, command, out, user, channel, args)
+
+	def _run (self, flow, function, command, out, user, channel, args):
+		'''
+		Runs a single command, recording its calls, errors and latency,
+		including the time spent waiting for a Deferred, or pulling the
+		items of a lazy flow returned by the command
+		'''
+		metrics = self.factory.metrics
+		label = ('command', command)
+		metrics.count ('calls', label)
+		spec = self.commands.get (command)
+		start = time ()
+		try:
+			if spec is not None and spec.blocking:
+				result = self._offload (spec, function, flow, out, user, channel, args)
+			else:
+				result = function (flow, out, user, channel, *args)
+		except:
+			metrics.count ('errors', label)
+			metrics.observe ('latency_seconds', label, time () - start)
+			raise
+		if isinstance (result, Deferred):
+			def done (result):
+				if isinstance (result, Failure):
+					metrics.count ('errors', label)
+				metrics.observe ('latency_seconds', label, time () - start)
+				return result
+			return result.addBoth (done)
+		if hasattr (result, 'next'):
+			return timed (result, metrics, label, time () - start)
+		metrics.observe ('latency_seconds', label, time () - start)
+		return result
+
+	def _offload (self, spec, function, flow, out, user, channel, args):
+		'''
+		Runs a blocking command in the factory thread pool, recording the
+		time it waited for its turn and a thread. Lazy input flows are
+		pulled first, so that upstream commands only run in the reactor
+		thread
+		'''
+		if hasattr (flow, 'next'):
+			flow = list (flow)
+		queued, started = time (), []
+		def run ():
+			started.append (time ())
+			return function (flow, out, user, channel, *args)
+		def done (result):
+			if started:
+				self.factory.metrics.observe ('queue_seconds', ('command', spec.name), started[0] - queued)
+			return result
+		semaphore = self.factory.semaphore (spec.name, spec.concurrency or self.factory.threads)
+		return semaphore.run (deferToThreadPool, reactor, self.factory.threadpool, run).addBoth (done)
+
+	def _cached (self, spec, flow, function, out, user, channel, args):
+		'''
+		Replays the output and result of a cacheable command for the same
+		arguments and input flow, or runs it and caches them. Flows larger
+		than the factory `cacheflow` and outputs holding lazy lines are
+		never cached
+		'''
+		limit = self.factory.cacheflow
+		if hasattr (flow, 'next'):
+			head = list (islice (flow, limit + 1))
+			if len (head) > limit:
+				return self._run (chain (head, flow), function, spec.name, out, user, channel, args)
+			flow = head
+		scope = {'user': (user, channel), 'channel': channel}.get (spec.scope)
+		try:
+			key = (spec.name, args, scope, tuple (flow) if isinstance (flow, list) else flow)
+			hash (key)
+		except TypeError: # unhashable flow
+			return self._run (flow, function, spec.name, out, user, channel, args)
+		results = self.factory.results
+		metrics = self.factory.metrics
+		now = self.factory.clock.seconds ()
+		entry = results.get (key)
+		if entry is not None and entry[0] > now:
+			metrics.count ('cachehits', ('command', spec.name))
+			out += entry[1]
+			return list (entry[2]) if isinstance (entry[2], list) else entry[2]
+		metrics.count ('cachemisses', ('command', spec.name))
+		before = len (out)
+		def store (result):
+			lines = out[before:]
+			if not all ([isinstance (line, str) for line in lines]):
+				return result
+			if hasattr (result, 'next'):
+				head = list (islice (result, limit + 1))
+				if len (head) > limit:
+					return chain (head, result)
+				result = head
+			results[key] = (now + spec.cache, lines, list (result) if isinstance (result, list) else result)
+			return result
+		result = self._run (flow, function, spec.name, out, user, channel, args)
+		if isinstance (result, Deferred):
+			return result.addCallback (store)
+		return store (result)
+
+	def connectionMade (self):
+		'''
+		Initialization of specific attributes
+		'''
+		self._plans = LRUCache (self.factory.plans)
+		self._generation = self.factory.generation
+		self._handlers = dict ([(name, getattr (self, name)) for name in self.commands])
+		self._capabilitycache = LRUCache (self.factory.capabilities)
+		self._keys = {}
+		super(BotProtocol, self).connectionMade ()
+
 	def signedOn (self):
 		'''
-		Simply joins every channel when the robot is connected
+		Joins every configured channel, and every channel joined before the
+		connection was lost, once the server told us its limits
+		'''
+		self.factory.resetDelay ()
+		joined = self.factory.joined
+		configured = set ([channel.lower () for channel in self.factory.channels])
+		self._joining = ([joined.get (channel.lower (), (channel, None)) for channel in self.factory.channels] +
+		                 [value for channel, value in joined.items () if not channel in configured])
+		self._joinwait = self.factory.clock.callLater (self.factory.joinwait, self._rejoin)
+
+	def receivedMOTD (self, motd):
+		self._rejoin ()
+		super(BotProtocol, self).receivedMOTD (motd)
+
+	def irc_ERR_NOMOTD (self, prefix, params):
+		self._rejoin ()
+
+	def _rejoin (self):
+		if self._joinwait.active ():
+			self._joinwait.cancel ()
+		channels, self._joining = self._joining, []
+		self.joinall (channels)
+
+	def join (self, channel, key = None):
+		self.joinall ([(channel, key)])
+
+	def joinall (self, channels):
+		'''
+		Joins several channels given as (channel, key) tuples, batched in as
+		few JOIN lines as the server line length and TARGMAX allow
+		'''
+		targmax = self.supported.getFeature ('TARGMAX') or {}
+		limit = targmax.get ('JOIN') if 'JOIN' in targmax else self.factory.joinbatch
+		def flush (batch, keys):
+			self.sendLine (' '.join (['JOIN', ','.join (batch)] + ([','.join (keys)] if keys else [])))
+		batch, keys, length = [], [], 0
+		for channel, key in sorted (channels, key = lambda (channel, key): not key): # keys first
+			if channel[0] not in CHANNEL_PREFIXES:
+				channel = '#' + channel
+			if key:
+				self._keys[channel.lower ()] = key
+			size = len (channel) + (len (key) + 2 if key else 1)
+			if batch and ((limit and len (batch) >= limit) or length + size > 500):
+				flush (batch, keys)
+				batch, keys, length = [], [], 0
+			batch.append (channel)
+			keys += [key] if key else []
+			length += size
+		if batch:
+			flush (batch, keys)
+
+	def joined (self, channel):
+		self.factory.joined[channel.lower ()] = (channel, self._keys.get (channel.lower ()))
+		super(BotProtocol, self).joined (channel)
+
+	def left (self, channel):
+		self.factory.joined.pop (channel.lower (), None)
+		super(BotProtocol, self).left (channel)
+
+	def kickedFrom (self, channel, kicker, message):
+		self.factory.joined.pop (channel.lower (), None)
+		super(BotProtocol, self).kickedFrom (channel, kicker, message)
+
+	def irc_ERR_NICKNAMEINUSE (self, prefix, params):
+		'''
+		Picks another nickname while registering, simply keeps the current
+		one afterwards
 		'''
-		for channel in self.factory.channels:
-			self.join (channel)
+		if not self._registered:
+			super(BotProtocol, self).irc_ERR_NICKNAMEINUSE (prefix, params)
+
+	def userQuit (self, user, quitMessage):
+		if user == self.factory.nickname: # taking our nickname back
+			self.setNick (self.factory.nickname)
+		self._capabilitycache.pop (user.lower (), None)
+		super(BotProtocol, self).userQuit (user, quitMessage)
+
+	def userRenamed (self, oldname, newname):
+		if oldname == self.factory.nickname:
+			self.setNick (self.factory.nickname)
+		self._capabilitycache.pop (oldname.lower (), None)
+		self._capabilitycache.pop (newname.lower (), None)
+		super(BotProtocol, self).userRenamed (oldname, newname)
 
 	def noticed (self, user, channel, message):
 		'''
@@ -137,7 +589,8 @@ class BotProtocol (IRCClient, object):
 			message = message[len (self.factory.bang):]
 		else:
 			channel = user.split ('!')[0] # trick to reply directly
-		self._handle (user, channel, message, True).callback (None)
+		if self._admit (user, channel, message):
+			self._handle (user, channel, message, True).callback (None)
 			
 	def sendmsg (self, out, channel, message):
 		'''
@@ -158,16 +611,97 @@ class BotProtocol (IRCClient, object):
 		'''
 		self.sendLine ('%s %s' % (command, ' '.join (args)))
 				
-class BotFactory (ClientFactory, object):
+class BotFactory (ReconnectingClientFactory, object):
 	'''
 	I'm a generic irc bot factory
+	
+	Lost connections are retried with an exponential backoff and jitter,
+	up to `maxDelay` seconds; channels joined are kept in `joined` and
+	joined again, `joinbatch` channels per line unless the server
+	announces its own limit, as soon as the server MOTD is received or
+	after `joinwait` seconds
+	
+	Compiled command pipelines are cached by my protocols, up to `plans`
+	entries, as well as the commands every user may run, for up to
+	`capabilities` nicknames; whenever aliases or permissions change,
+	simply call `invalidate` so that they are compiled again
+	
+	Flows displayed at the end of a command are cut at `outputlength`
+	characters
+
+	Command calls, errors and latencies are collected in `metrics`, shared
+	by every protocol I build, as well as the `results` of cacheable
+	commands, up to `resultcache` of them, for input flows of up to
+	`cacheflow` items
+
+	Blocking commands run in my `threadpool` of up to `threads` threads
 	'''
+	plans = 256
+	capabilities = 1024
+	generation = 0
+	outputlength = 1024
+	resultcache = 1024
+	cacheflow = 1000
+	threads = 4
+	maxDelay = 300
+	clock = reactor
+	joinbatch = 10
+	joinwait = 5
+	_metrics = None
+	_results = None
+	_threadpool = None
+	_semaphores = None
+
 	def __init__ (self, nickname, password, channels, bang, pipe):
 		self.nickname = nickname
 		self.password = password
 		self.channels = channels
 		self.bang = bang
 		self.pipe = pipe
+		self.joined = {}
 
-	def clientConnectionLost (self, connector, reason):
-		connector.connect ()
+	def invalidate (self):
+		'''
+		Drops every compiled command pipeline
+		'''
+		self.generation += 1
+
+	@property
+	def metrics (self):
+		'''
+		The metrics registry, created on first use
+		'''
+		if self._metrics is None:
+			self._metrics = Metrics ()
+		return self._metrics
+
+	@property
+	def results (self):
+		'''
+		The results cache of cacheable commands, flushed whenever I am
+		invalidated
+		'''
+		if self._results is None or not self._results[0] == self.generation:
+			self._results = (self.generation, LRUCache (self.resultcache))
+		return self._results[1]
+
+	@property
+	def threadpool (self):
+		'''
+		The thread pool running blocking commands, started on first use
+		'''
+		if self._threadpool is None:
+			self._threadpool = ThreadPool (0, self.threads, 'pyircbot')
+			self._threadpool.start ()
+			reactor.addSystemEventTrigger ('during', 'shutdown', self._threadpool.stop)
+		return self._threadpool
+
+	def semaphore (self, command, tokens):
+		'''
+		Returns the semaphore bounding concurrent runs of a command
+		'''
+		if self._semaphores is None:
+			self._semaphores = {}
+		if not command in self._semaphores:
+			self._semaphores[command] = DeferredSemaphore (tokens)
+		return self._semaphores[command]
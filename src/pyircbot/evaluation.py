@@ -16,34 +16,159 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from twisted.internet.defer import Deferred
-from core import BotProtocol, botcommand
-from ast import literal_eval
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, gatherResults
+from twisted.python import log
+from core import BotProtocol, FlowLine, botcommand, iterflow
+from sandbox import compile_expression, evaluate
+from pool import EvaluationPool
+from itertools import chain, imap, islice
+
+def sandbox (factory):
+	'''
+	Returns the evaluation pool shared by the factory connections, None if
+	expressions are evaluated in process
+	'''
+	pool = getattr (factory, '_sandbox', None)
+	if pool is None and getattr (factory, 'sandboxworkers', 2):
+		pool = EvaluationPool (getattr (factory, 'sandboxworkers', 2),
+		                       getattr (factory, 'sandboxjobs', 100),
+		                       getattr (factory, 'sandboxcpu', 2),
+		                       getattr (factory, 'sandboxmemory', 128 << 20),
+		                       getattr (factory, 'sandboxtimeout', 5),
+		                       getattr (factory, 'clock', reactor))
+		reactor.addSystemEventTrigger ('before', 'shutdown', pool.stop)
+		factory._sandbox = pool
+	return pool
+
+class MassCall (object):
+	'''
+	I run a command line over every item of a flow, with at most
+	`concurrency` items running at once. Every item succeeds or fails on
+	its own, and once every item is done or the deadline is reached I fire
+	with the list of results, in order; items still running then are left
+	alone, neither their results nor their output are used
+	'''
+	def __init__ (self, bot, user, channel, command, items, concurrency, deadline, clock):
+		self.bot = bot
+		self.user = user
+		self.channel = channel
+		self.command = command
+		self.items = items
+		self.concurrency = concurrency
+		self.results = []
+		self.running = 0
+		self.done = Deferred ()
+		self._exhausted = False
+		self._pumping = False
+		self._timeout = clock.callLater (deadline, self._finish)
+
+	def start (self):
+		self._pump ()
+		return self.done
+
+	def _pump (self):
+		'''
+		Launches items until the concurrency limit is reached; items
+		completing synchronously simply let the loop go on, so that the
+		stack does not grow with the number of items
+		'''
+		if self._pumping:
+			return
+		self._pumping = True
+		try:
+			while not self.done.called and not self._exhausted and self.running < self.concurrency:
+				try:
+					item = self.items.next ()
+				except StopIteration:
+					self._exhausted = True
+					break
+				index = len (self.results)
+				self.results.append (None)
+				self.running += 1
+				d = self.bot._handle (self.user, self.channel, self.command.replace ('?', str (item)), True,
+				                      lambda: not self.done.called)
+				d.addCallbacks (self._completed, self._failed, (index,), None, (index,))
+				d.callback (None)
+		finally:
+			self._pumping = False
+		if self._exhausted and not self.running:
+			self._finish ()
+
+	def _completed (self, result, index):
+		self.results[index] = result
+		self.running -= 1
+		self._pump ()
+
+	def _failed (self, failure, index):
+		if not self.done.called:
+			log.err (failure)
+		self.running -= 1
+		self._pump ()
+
+	def _finish (self):
+		if self.done.called:
+			return
+		if self._timeout.active ():
+			self._timeout.cancel ()
+		flow = []
+		try:
+			for result in self.results:
+				if isinstance (result, list) or hasattr (result, 'next'):
+					flow.extend (result)
+				elif result is not None:
+					flow.append (result)
+		except Exception:
+			self.done.errback ()
+		else:
+			self.done.callback (flow)
 
 class ListBulkingBotProtocol (BotProtocol):
 	'''
 	I am a bot protocol that allow users to manipulate lists without having to
 	evaluate list comprehensions
+	
+	Lists are streamed through the pipeline: my commands produce items one
+	at a time, pulled only when the result is finally displayed
+	
+	The `mass` command runs at most `massconcurrency` items at once, and
+	gives up on items still running after `massdeadline` seconds
+	
+	When the factory `sandboxflows` is set, `map` and `filter` evaluate
+	their expression in the sandbox pool instead, by batches of
+	`sandboxbatch` items; the whole flow is then pulled at once
 	'''
-	@botcommand
+	@botcommand (cache = 60)
 	def filter (self, flow, out, user, channel, *expr):
 		'''
 		\x02filter\x02 <expression>
 		I filter the input list using the given Python expression, input list
 		items are bound to 'x', the expression should evaluate to True or False
 		'''
-		expr = ' '.join (expr)
-		return filter (lambda x: self._safe_eval (expr, x=x), flow)
+		code = compile_expression (' '.join (expr))
+		if code is None:
+			return iter (())
+		d = self._sandboxed ('filter', ' '.join (expr), flow)
+		if d:
+			return d
+		namespace = {'__builtins__': None}
+		return (x for x in iterflow (flow) if eval (code, namespace, {'x': x}))
 
-	@botcommand
+	@botcommand (cache = 60)
 	def map (self, flow, out, user, channel, *expr):
 		'''
 		\x02map\x02 <expression>
 		I map the given expression to the input list, the item being bount to the
 		variable 'x'.
 		'''
-		expr = ' '.join (expr)
-		return map (lambda x: self._safe_eval (expr, x=x), flow)
+		code = compile_expression (' '.join (expr))
+		if code is None:
+			return (None for x in iterflow (flow))
+		d = self._sandboxed ('map', ' '.join (expr), flow)
+		if d:
+			return d
+		namespace = {'__builtins__': None}
+		return (eval (code, namespace, {'x': x}) for x in iterflow (flow))
 
 	@botcommand
 	def cat (self, flow, out, user, channel, *args):
@@ -51,10 +176,7 @@ class ListBulkingBotProtocol (BotProtocol):
 		\x02cat\x02 <item> [<item> [...]]
 		Simply concatenates input list with arguments
 		'''
-		result = (flow if type(flow) is list else []) + list(args)
-		result = [str(x) for x in result]
-		# out.append ('\x02Output:\x02 %s' % ', '.join (result))
-		return result
+		return imap (str, chain (iterflow (flow), args))
 
 	@botcommand
 	def echo (self, flow, out, user, channel, name = 'Output'):
@@ -62,7 +184,7 @@ class ListBulkingBotProtocol (BotProtocol):
 		\x02echo\x02 [<name>]
 		Displays the input list, named as specified
 		'''
-		out.append ('\x02%s:\x02 %s' % (name, ', '.join (flow)))
+		out.append (FlowLine ('\x02%s:\x02 ' % name, flow))
 
 	@botcommand
 	def mass (self, flow, out, user, channel, *args):
@@ -70,41 +192,69 @@ class ListBulkingBotProtocol (BotProtocol):
 		\x02mass\x02 <command> [<arguments>]
 		Execute the command with the specified arguments mapped on every piped list item
 		The arguments string must contain '?' exactly once, which will hold the iterated items
+		Items are run concurrently, their results are gathered in order as the output list
 		'''
-		d = Deferred ()
 		command = ' '.join (args).replace ('=>', '->')
-		for item in flow:
-			d.chainDeferred (self._handle (user, channel, command.replace ('?', item), True))
-		d.callback (None)
+		return MassCall (self, user, channel, command, iterflow (flow),
+		                 getattr (self.factory, 'massconcurrency', 8),
+		                 getattr (self.factory, 'massdeadline', 60),
+		                 getattr (self.factory, 'clock', reactor)).start ()
+
+	def _sandboxed (self, mode, expr, flow):
+		'''
+		Sends the flow to the sandbox pool by batches if configured so,
+		returns a Deferred firing with the whole resulting list
+		'''
+		pool = sandbox (self.factory) if getattr (self.factory, 'sandboxflows', False) else None
+		if pool is None:
+			return None
+		items = iterflow (flow)
+		size = getattr (self.factory, 'sandboxbatch', 1000)
+		batches = []
+		batch = list (islice (items, size))
+		while batch:
+			batches.append (pool.evaluate (mode, expr, batch))
+			batch = list (islice (items, size))
+		d = gatherResults (batches, consumeErrors = True)
+		d.addCallback (lambda results: list (chain (*results)))
 		return d
 
 	def _safe_eval(self, expr, **kwargs):
 		'''
 		Given the expression, evaluate it in a relatively safe context.
 		'''
-		if set(':_').intersection(expr):
+		code = compile_expression (expr)
+		if code is None:
 			return None
-		return eval (expr, {'__builtins__':None},kwargs)
+		return eval (code, {'__builtins__':None},kwargs)
 
 class PyBotProtocol (BotProtocol):
 	'''
 	I am a bot protocol that allow the user to evaluate Python statements
+	
+	Statements are evaluated by a pool of `sandboxworkers` processes, each
+	statement being limited to `sandboxcpu` seconds of CPU time,
+	`sandboxmemory` bytes and `sandboxtimeout` seconds; every worker is
+	replaced after `sandboxjobs` statements. Setting `sandboxworkers` to 0
+	evaluates statements in process
 	'''
-	@botcommand
+	@botcommand (cache = 60)
 	def py (self, flow, out, user, channel, *args):
 		'''
 		\x02py\x02 <python statement>
 		Executes the specified python statement. The incoming piped message is stored in 'x'
 		Examples : 'py 1', 'py 1+1', 'py [1,2,3]'
 		'''
+		if hasattr (flow, 'next'): # streamed flows are fully pulled here
+			flow = list (flow)
 		expr = ' '.join (args)
-		if set(':_').intersection(expr):
-			result = None
-		else:
-			result = eval (expr,{'__builtins__':None},{'x': flow})
-		if type (result) is list:
-			result = [str (x) for x in result]
-		else:
-			result = [str (result)]
+		pool = sandbox (self.factory)
+		if compile_expression (expr) is None or pool is None:
+			return self._pyresult (evaluate ('py', expr, flow), out)
+		d = pool.evaluate ('py', expr, flow)
+		d.addCallback (self._pyresult, out)
+		return d
+
+	def _pyresult (self, result, out):
 		out.append ('\x02Python:\x02 %s' % ', '.join (result))
 		return result
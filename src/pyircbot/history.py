@@ -0,0 +1,407 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from core import BotProtocol, botcommand
+from twisted.internet import reactor
+from twisted.python import log
+from array import array
+from bisect import bisect_left
+from hashlib import md5
+from glob import glob
+from time import time
+import threading
+import struct
+import mmap
+import os
+import re
+
+TYPECODE = 'L' if array ('L').itemsize == 8 else 'Q'
+WORDS = re.compile (r'\w+')
+
+def term (word):
+	'''
+	Returns the 64 bits key of an index term
+	'''
+	return struct.unpack ('<Q', md5 (word).digest ()[:8])[0]
+
+def contains (offsets, offset):
+	'''
+	Tells whether a sorted sequence of offsets contains the given one
+	'''
+	index = bisect_left (offsets, offset)
+	return index < len (offsets) and offsets[index] == offset
+
+def words (text):
+	'''
+	Returns the set of indexed words from a text
+	'''
+	return set ([word for word in WORDS.findall (text.lower ()) if len (word) > 1])
+
+class Segment (object):
+	'''
+	I am an immutable segment of the history index, named after the
+	messages file size it covers. My terms file is a table of (key, start,
+	count) records sorted by key, pointing to the postings file where
+	every term has the sorted offsets of the messages using it. Both are
+	read with mmap
+	'''
+	record = struct.Struct ('<QQI')
+
+	def __init__ (self, path):
+		self.end = int (os.path.basename (path), 16)
+		self._files = [open (path + ext, 'rb') for ext in ('.terms', '.postings')]
+		self._terms, self._postings = [mmap.mmap (f.fileno (), 0, access = mmap.ACCESS_READ)
+		                               for f in self._files]
+		self._size = len (self._terms) // self.record.size
+
+	@classmethod
+	def write (cls, path, end, postings):
+		'''
+		Writes a segment from a dictionary of term keys and offset lists,
+		returns the segment path
+		'''
+		path = os.path.join (path, '%016x' % end)
+		with open (path + '.postings.tmp', 'wb') as data:
+			with open (path + '.terms.tmp', 'wb') as terms:
+				start = 0
+				for key in sorted (postings):
+					offsets = array (TYPECODE, postings[key])
+					data.write (offsets.tostring ())
+					terms.write (cls.record.pack (key, start, len (offsets)))
+					start += len (offsets)
+		os.rename (path + '.postings.tmp', path + '.postings')
+		os.rename (path + '.terms.tmp', path + '.terms') # the terms file marks complete segments
+		return path
+
+	def postings (self, key):
+		'''
+		Returns the sorted offsets of the messages using a term
+		'''
+		low, high = 0, self._size
+		while low < high:
+			middle = (low + high) // 2
+			found, start, count = self.record.unpack_from (self._terms, middle * self.record.size)
+			if found < key:
+				low = middle + 1
+			elif found > key:
+				high = middle
+			else:
+				offsets = array (TYPECODE)
+				offsets.fromstring (self._postings[start * offsets.itemsize:(start + count) * offsets.itemsize])
+				return offsets
+		return ()
+
+	def close (self):
+		for f in self._terms, self._postings:
+			f.close ()
+		for f in self._files:
+			f.close ()
+
+class History (object):
+	'''
+	I am an indexed history of channel messages. Messages are appended to a
+	messages file and indexed in memory, every `segment` messages the
+	in-memory index is written as a new `Segment`. Every message is indexed
+	by its words, its author and its channel, so that `search` and `seen`
+	only read the matching messages.
+	
+	Messages appended after the last segment are indexed again when I am
+	opened, and a last line torn by a crash is dropped.
+	
+	Segments are written by a background thread, one at a time, while the
+	index they hold is still searched in memory.
+	
+	Searches may run from threads: they only hold my lock to copy the
+	postings of the in-memory index and to read messages
+	'''
+	def __init__ (self, path, segment = 50000):
+		self.path = path
+		self.segment = segment
+		if not os.path.isdir (path):
+			os.makedirs (path)
+		for temporary in glob (os.path.join (path, '*.tmp')):
+			os.remove (temporary)
+		self._segments = [Segment (name[:-len ('.terms')])
+		                  for name in sorted (glob (os.path.join (path, '*.terms')))]
+		self._messages = open (os.path.join (path, 'messages'), 'ab+')
+		self._map = None
+		self._lock = threading.Lock ()
+		self._pending = {}
+		self._count = 0
+		self._writing = []
+		self._writer = None
+		self._broken = False
+		offset = self._segments[-1].end if self._segments else 0
+		self._messages.seek (offset)
+		for line in self._messages:
+			fields = line.split ('\t', 3)
+			if not line.endswith ('\n') or len (fields) < 4:
+				# a line torn by a crash is the last one, drop it
+				self._messages.truncate (offset)
+				break
+			self._index (offset, *fields[1:3] + [fields[3][:-1]])
+			offset += len (line)
+		self._messages.seek (0, os.SEEK_END)
+		self._size = self._messages.tell ()
+
+	def _index (self, offset, channel, nick, message):
+		keys = [term (word) for word in words (message)]
+		keys += [term ('\x01' + nick.lower ()), term ('\x02' + channel.lower ())]
+		for key in keys:
+			self._pending.setdefault (key, []).append (offset)
+		self._count += 1
+
+	def add (self, when, channel, nick, message):
+		'''
+		Appends and indexes a message
+		'''
+		line = '%d\t%s\t%s\t%s\n' % (when, channel, nick, message.replace ('\n', ' '))
+		with self._lock:
+			offset = self._size
+			self._messages.write (line)
+			self._size += len (line)
+			self._index (offset, channel, nick, message)
+			if self._count >= self.segment:
+				self._rotate ()
+
+	def _rotate (self):
+		'''
+		Hands the in-memory index over to a thread writing it as a new
+		segment, after the segments already being written
+		'''
+		self._messages.flush ()
+		pending = self._pending
+		self._pending, self._count = {}, 0
+		self._writing.append (pending)
+		self._writer = threading.Thread (target = self._write, args = (pending, self._size, self._writer))
+		self._writer.start ()
+
+	def _write (self, pending, end, previous):
+		if previous is not None:
+			previous.join ()
+		if self._broken:
+			return # later segments would hide the missing one
+		try:
+			path = Segment.write (self.path, end, pending)
+		except Exception:
+			log.err (None, 'history segment not written, messages will be indexed again when opened')
+			self._broken = True
+			return # still searched in memory
+		with self._lock:
+			self._segments.append (Segment (path))
+			self._writing.remove (pending)
+
+	def _wait (self):
+		'''
+		Waits for the segments being written
+		'''
+		writer = self._writer
+		if writer is not None:
+			writer.join ()
+
+	def flush (self):
+		'''
+		Writes the in-memory index as a new segment
+		'''
+		self._wait ()
+		with self._lock:
+			self._flush ()
+
+	def _flush (self):
+		self._messages.flush ()
+		if self._pending and not self._broken:
+			path = Segment.write (self.path, self._size, self._pending)
+			self._segments.append (Segment (path))
+			self._pending, self._count = {}, 0
+
+	def _sources (self, keys):
+		'''
+		Returns postings lookups for the given keys, from the most recent
+		messages to the oldest
+		'''
+		with self._lock:
+			pending = dict ([(key, list (self._pending.get (key, ()))) for key in keys])
+			writing = [dict ([(key, postings.get (key, ())) for key in keys]) for postings in self._writing]
+			segments = list (self._segments)
+		return ([pending.get] + [postings.get for postings in reversed (writing)] +
+		        [segment.postings for segment in reversed (segments)])
+
+	def _read (self, offset):
+		with self._lock:
+			if self._map is None or offset >= len (self._map):
+				self._messages.flush ()
+				if self._map:
+					self._map.close ()
+				self._map = mmap.mmap (self._messages.fileno (), 0, access = mmap.ACCESS_READ)
+			end = self._map.find ('\n', offset)
+			when, channel, nick, message = self._map[offset:end].split ('\t', 3)
+		return int (when), channel, nick, message
+
+	def search (self, text, channel = None, nick = None, limit = 100):
+		'''
+		Returns up to `limit` messages using every word of the given text,
+		from the given channel and nick if any, most recent first, as
+		(time, channel, nick, message) tuples
+		'''
+		keys = [term (word) for word in words (text)]
+		if channel:
+			keys.append (term ('\x02' + channel.lower ()))
+		if nick:
+			keys.append (term ('\x01' + nick.lower ()))
+		if not keys:
+			raise ValueError ('nothing to search for')
+		results = []
+		for postings in self._sources (keys):
+			lists = sorted ([postings (key) for key in keys], key = len)
+			matches = []
+			for offset in reversed (lists[0]):
+				if all ([contains (other, offset) for other in lists[1:]]):
+					matches.append (offset)
+					if len (results) + len (matches) >= limit:
+						break
+			results += [self._read (offset) for offset in matches]
+			if len (results) >= limit:
+				break
+		return results
+
+	def seen (self, nick, channel = None):
+		'''
+		Returns the last message from a nick, in the given channel if any,
+		as a (time, channel, nick, message) tuple, None if the nick was
+		never seen
+		'''
+		if channel:
+			messages = self.search ('', channel, nick, limit = 1)
+			return messages[0] if messages else None
+		key = term ('\x01' + nick.lower ())
+		for postings in self._sources ([key]):
+			offsets = postings (key)
+			if len (offsets):
+				return self._read (offsets[-1])
+		return None
+
+	def close (self):
+		'''
+		Flushes and closes every file, the in-memory index is rebuilt when
+		opened again
+		'''
+		self._wait ()
+		self._messages.flush ()
+		if self._map:
+			self._map.close ()
+		self._messages.close ()
+		for segment in self._segments:
+			segment.close ()
+
+def history (factory):
+	'''
+	Returns the history shared by the factory connections
+	'''
+	if getattr (factory, '_history', None) is None:
+		factory._history = History (getattr (factory, 'historypath', 'history'),
+		                            getattr (factory, 'historysegment', 50000))
+		reactor.addSystemEventTrigger ('before', 'shutdown', factory._history.close)
+	return factory._history
+
+def ago (seconds):
+	'''
+	Returns a short human readable duration
+	'''
+	for unit, length in (('d', 86400), ('h', 3600), ('m', 60)):
+		if seconds >= length:
+			return '%d%s' % (seconds // length, unit)
+	return '%ds' % seconds
+
+class HistoryBotProtocol (BotProtocol):
+	'''
+	I am a bot protocol which records channel messages, but commands, in
+	an indexed `History` stored in the factory `historypath` directory,
+	and answers seen and grep commands from it
+	
+	In a channel, seen and grep only search that channel; in private, they
+	search the channels the user shares with me according to the
+	membership index of a `WhoBotProtocol`, and are refused without one
+	'''
+	def connectionMade (self):
+		self._history = history (self.factory)
+		super(HistoryBotProtocol, self).connectionMade ()
+
+	def privmsg (self, user, channel, message):
+		if channel[0] == '#' and not message.startswith (self.factory.bang):
+			self._history.add (time (), channel, user.split ('!')[0], message)
+		super(HistoryBotProtocol, self).privmsg (user, channel, message)
+
+	def _channels (self, user):
+		'''
+		Returns the channels the user is known to be in along with me, from
+		the membership index of a `WhoBotProtocol` if any
+		'''
+		nick = user.split ('!')[0].lower ()
+		return [channel for channel, members in getattr (self, '_members', {}).items () if nick in members]
+
+	def _format (self, (when, channel, nick, message)):
+		return '[%s ago] %s <%s> %s' % (ago (time () - when), channel, nick, message)
+
+	@botcommand
+	def seen (self, flow, out, user, channel, nick):
+		'''
+		\x02seen\x02 <nick>
+		Displays the last message from the given nick in the channel, or in
+		private in the channels we are both in, output flow is the message
+		line
+		'''
+		if channel[0] == '#':
+			message = self._history.seen (nick, channel)
+		else:
+			channels = self._channels (user)
+			if not channels:
+				out.append ('seen only searches channels we are both in')
+				return []
+			message = max ([self._history.seen (nick, name) for name in channels])
+		if message is None:
+			out.append ('I have never seen %s' % nick)
+			return []
+		out.append (self._format (message))
+		return [self._format (message)]
+
+	@botcommand (blocking = True, concurrency = 2)
+	def grep (self, flow, out, user, channel, *words):
+		'''
+		\x02grep\x02 <word> [<word>...]
+		Searches the channel history for messages with every given word,
+		or in private the history of the channels we are both in, output
+		flow is the list of matching lines, most recent first
+		'''
+		channels = [channel] if channel[0] == '#' else self._channels (user)
+		if not channels:
+			out.append ('grep only searches channels we are both in')
+			return []
+		limit = getattr (self.factory, 'historylimit', 100)
+		messages = []
+		for name in channels:
+			messages += self._history.search (' '.join (words), name, limit = limit)
+		messages.sort (reverse = True)
+		lines = [self._format (message) for message in messages[:limit]]
+		shown = getattr (self.factory, 'historyshown', 3)
+		out += lines[:shown]
+		if len (lines) > shown:
+			out.append ('... %d more' % (len (lines) - shown))
+		elif not lines:
+			out.append ('No match')
+		return lines
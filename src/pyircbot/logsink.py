@@ -0,0 +1,145 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from twisted.python.logfile import LogFile
+from twisted.python import log
+from collections import deque
+from time import time
+import threading
+import marshal
+import json
+import os
+
+def text (value):
+	'''
+	Returns a value fit for JSON, decoding byte strings as UTF-8 with
+	replacement characters and every item of lists and tuples
+	'''
+	if isinstance (value, str):
+		return value.decode ('utf-8', 'replace')
+	if isinstance (value, (list, tuple)):
+		return [text (item) for item in value]
+	return value
+
+class LogSink (object):
+	'''
+	I am a structured log sink. Records are simply queued by the reactor
+	thread, then formatted and written by batches from a writer thread to
+	a file rotated every `rotate` bytes, either as JSON lines or as
+	marshalled tuples.
+	
+	Once `size` records are waiting, new ones are dropped, or the caller
+	blocks until the writer catches up if `policy` is 'block'. Pending
+	records are written when I am closed. A record failing to be formatted
+	is skipped and counted in `failed`, byte strings which are not UTF-8
+	being written with replacement characters in JSON
+	'''
+	fields = {
+		'incoming': ('user', 'channel', 'message'),
+		'outgoing': ('channel', 'message'),
+		'command': ('command', 'args'),
+	}
+
+	def __init__ (self, path, format = 'json', size = 10000, policy = 'drop',
+	              batch = 500, interval = 1, rotate = 1 << 20, keep = 10):
+		self.format = format
+		self.size = size
+		self.policy = policy
+		self.batch = batch
+		self.interval = interval
+		self.dropped = 0
+		self.failed = 0
+		self.written = 0
+		self._queue = deque ()
+		self._closed = False
+		self._ready = threading.Condition ()
+		self._room = threading.Condition (self._ready)
+		self._file = LogFile (os.path.basename (path), os.path.dirname (os.path.abspath (path)),
+		                      rotateLength = rotate, maxRotatedFiles = keep)
+		self._writer = threading.Thread (target = self._run, name = 'LogSink %s' % path)
+		self._writer.daemon = True
+		self._writer.start ()
+
+	def put (self, event, *values):
+		'''
+		Queues a record, returns False if it was dropped
+		'''
+		with self._ready:
+			if len (self._queue) >= self.size:
+				if self.policy == 'block':
+					while len (self._queue) >= self.size and not self._closed:
+						self._room.wait (self.interval)
+				else:
+					self.dropped += 1
+					return False
+			self._queue.append ((time (), event) + values)
+			if len (self._queue) >= self.batch:
+				self._ready.notify ()
+		return True
+
+	def _format (self, record):
+		if self.format == 'marshal':
+			return marshal.dumps (record)
+		data = dict (zip (self.fields.get (record[1], ()), [text (value) for value in record[2:]]))
+		data['time'], data['event'] = record[:2]
+		return json.dumps (data) + '\n'
+
+	def _formatted (self, records):
+		'''
+		Formats records one by one, skipping and counting those that fail
+		'''
+		lines = []
+		for record in records:
+			try:
+				lines.append (self._format (record))
+			except Exception:
+				self.failed += 1
+				log.err (None, 'log sink record not formatted')
+		return lines
+
+	def _run (self):
+		while True:
+			with self._ready:
+				if len (self._queue) < self.batch and not self._closed:
+					self._ready.wait (self.interval)
+				records = [self._queue.popleft () for i in range (min (self.batch, len (self._queue)))]
+				closed = self._closed and not self._queue
+				self._room.notify_all ()
+			try:
+				if records:
+					lines = self._formatted (records)
+					self._file.write (''.join (lines))
+					self._file.flush ()
+					self.written += len (lines)
+			except Exception:
+				log.err (None, 'log sink writer failed')
+			if closed:
+				return
+
+	def close (self):
+		'''
+		Writes pending records, then closes the file
+		'''
+		if self._closed:
+			return
+		with self._ready:
+			self._closed = True
+			self._ready.notify ()
+		self._writer.join ()
+		self._file.close ()
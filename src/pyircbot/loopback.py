@@ -0,0 +1,172 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# This is a loopback IRC server, talking to a bot protocol in memory so
+# that bot behaviors might be measured and compared without any network
+
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
+from random import Random
+import resource
+import time
+import gc
+
+class LoopbackTransport (object):
+	'''
+	I am an in-memory transport handing every line written by the bot to
+	the loopback server
+	'''
+	disconnecting = False
+
+	def __init__ (self, server):
+		self.server = server
+		self._buffer = ''
+
+	def write (self, data):
+		self._buffer += data
+		while '\r\n' in self._buffer:
+			line, self._buffer = self._buffer.split ('\r\n', 1)
+			self.server.received (line)
+
+	def writeSequence (self, data):
+		self.write (''.join (data))
+
+	def loseConnection (self):
+		self.disconnecting = True
+
+	def getPeer (self):
+		return IPv4Address ('TCP', '127.0.0.1', 6667)
+
+	def getHost (self):
+		return IPv4Address ('TCP', '127.0.0.1', 0)
+
+class LoopbackServer (object):
+	'''
+	I am a fake IRC server: I register the bot, let it join channels
+	populated with `members` fake users, answer WHO and PING, and count
+	what the bot sends
+	'''
+	def __init__ (self, protocol, members = 50):
+		self.protocol = protocol
+		self.members = members
+		self.transport = LoopbackTransport (self)
+		self.nickname = None
+		self.channels = {}
+		self.lines = 0
+		self.messages = 0
+
+	def connect (self):
+		self.protocol.makeConnection (self.transport)
+
+	def send (self, line):
+		'''
+		Sends a raw line to the bot
+		'''
+		self.protocol.dataReceived (line + '\r\n')
+
+	def reply (self, numeric, *params):
+		self.send (':loopback %s %s %s' % (numeric, self.nickname, ' '.join (params)))
+
+	def received (self, line):
+		'''
+		Handles a line sent by the bot
+		'''
+		self.lines += 1
+		words = line.split (' ')
+		command = words[0].upper ()
+		if command == 'NICK':
+			self.nickname = words[1]
+		elif command == 'USER':
+			self.reply ('001', ':Welcome to the loopback network')
+			self.reply ('422', ':MOTD File is missing')
+		elif command == 'PING':
+			self.send (':loopback PONG loopback %s' % words[-1])
+		elif command == 'JOIN':
+			for channel in words[1].split (','):
+				nicks = self.channels.setdefault (channel, ['user%d' % i for i in range (self.members)])
+				self.send (':%s!bot@loopback JOIN %s' % (self.nickname, channel))
+				self.reply ('353', '=', channel, ':' + ' '.join ([self.nickname] + nicks))
+				self.reply ('366', channel, ':End of /NAMES list.')
+		elif command == 'WHO':
+			channel = words[1]
+			for nick in self.channels.get (channel, []):
+				self.reply ('352', channel, nick, '%s.example.org' % nick, 'loopback', nick, 'H', ':0 %s' % nick)
+			self.reply ('315', channel, ':End of /WHO list.')
+		elif command in ('PRIVMSG', 'NOTICE'):
+			self.messages += 1
+
+def synthetic (commands, channels = ('#bench',), users = 100, count = 10000, bang = '!', seed = 0):
+	'''
+	Generates a trace of `count` command lines picked among the given ones,
+	sent by random users to random channels
+	'''
+	random = Random (seed)
+	for i in range (count):
+		user = random.randrange (users)
+		yield ':user%d!u%d@host%d.example.org PRIVMSG %s :%s%s' % (
+			user, user, user, random.choice (channels), bang, random.choice (commands))
+
+def recorded (path):
+	'''
+	Reads a trace of raw IRC lines, as sent by a server, from a file
+	'''
+	with open (path) as trace:
+		for line in trace:
+			if line.strip ():
+				yield line.rstrip ('\r\n')
+
+def percentile (values, ratio):
+	return values[min (len (values) - 1, int (len (values) * ratio))] if values else 0.0
+
+def replay (protocol, factory, trace, interval = 0.01, members = 50):
+	'''
+	Connects a new instance of the given protocol class to a loopback
+	server, replays the trace and returns statistics: lines per second,
+	median and 99th percentile of the time spent handling a line, and
+	memory growth. The factory clock is replaced with a fake clock moved
+	forward by `interval` seconds for every line
+	'''
+	factory.clock = Clock ()
+	bot = protocol ()
+	bot.factory = factory
+	server = LoopbackServer (bot, members)
+	server.connect ()
+	gc.collect ()
+	objects = len (gc.get_objects ())
+	rss = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+	latencies = []
+	start = time.time ()
+	for line in trace:
+		stamp = time.time ()
+		server.send (line)
+		latencies.append (time.time () - stamp)
+		factory.clock.advance (interval)
+	elapsed = time.time () - start
+	gc.collect ()
+	latencies.sort ()
+	return {
+		'lines': len (latencies),
+		'seconds': elapsed,
+		'rate': len (latencies) / elapsed if elapsed else 0.0,
+		'p50': percentile (latencies, 0.5),
+		'p99': percentile (latencies, 0.99),
+		'messages': server.messages,
+		'objects': len (gc.get_objects ()) - objects,
+		'rss': resource.getrusage (resource.RUSAGE_SELF).ru_maxrss - rss,
+	}
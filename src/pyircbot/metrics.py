@@ -0,0 +1,147 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from bisect import bisect_left
+
+class Histogram (object):
+	'''
+	I am a latency histogram with fixed exponential buckets, in seconds
+	'''
+	buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+	           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+	def __init__ (self):
+		self.counts = [0] * (len (self.buckets) + 1)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe (self, value):
+		self.counts[bisect_left (self.buckets, value)] += 1
+		self.count += 1
+		self.sum += value
+
+	def quantile (self, ratio):
+		'''
+		Returns the upper bound of the bucket holding the given quantile
+		'''
+		rank, seen = ratio * self.count, 0
+		for bound, count in zip (self.buckets + (float ('inf'),), self.counts):
+			seen += count
+			if seen >= rank:
+				return bound
+		return float ('inf')
+
+	def merge (self, other):
+		self.counts = [a + b for a, b in zip (self.counts, other.counts)]
+		self.count += other.count
+		self.sum += other.sum
+
+class Metrics (object):
+	'''
+	I collect counters and latency histograms. Every metric has a name and
+	an optional label, a (name, value) tuple such as ('command', 'echo')
+	'''
+	def __init__ (self):
+		self.counters = {}
+		self.histograms = {}
+
+	def count (self, name, label = None, value = 1):
+		key = (name, label)
+		self.counters[key] = self.counters.get (key, 0) + value
+
+	def observe (self, name, label, value):
+		histogram = self.histograms.get ((name, label))
+		if histogram is None:
+			histogram = self.histograms[(name, label)] = Histogram ()
+		histogram.observe (value)
+
+	def labels (self, name):
+		'''
+		Returns the label values used with the given metric name
+		'''
+		return sorted (set ([label[1] for metric, label in self.counters.keys () + self.histograms.keys ()
+		                     if metric == name and label]))
+
+	def dump (self):
+		'''
+		Returns a JSON serializable snapshot of every metric
+		'''
+		return {
+			'counters': [[name, label, value] for (name, label), value in self.counters.items ()],
+			'histograms': [[name, label, histogram.counts, histogram.count, histogram.sum]
+			               for (name, label), histogram in self.histograms.items ()],
+		}
+
+	def merge (self, snapshot):
+		'''
+		Adds the metrics from a snapshot, as returned by `dump`, to mine
+		'''
+		for name, label, value in snapshot['counters']:
+			self.count (name, tuple (label) if label else None, value)
+		for name, label, counts, count, total in snapshot['histograms']:
+			key = (name, tuple (label) if label else None)
+			histogram = Histogram ()
+			histogram.counts, histogram.count, histogram.sum = list (counts), count, total
+			if key in self.histograms:
+				self.histograms[key].merge (histogram)
+			else:
+				self.histograms[key] = histogram
+
+	def prometheus (self, prefix = 'pyircbot'):
+		'''
+		Renders every metric in the Prometheus text exposition format
+		'''
+		def labels (label, extra = None):
+			pairs = ([label] if label else []) + ([extra] if extra else [])
+			return '{%s}' % ','.join (['%s="%s"' % (key, escape (value)) for key, value in pairs]) if pairs else ''
+		lines = []
+		for (name, label), value in sorted (self.counters.items ()):
+			lines.append ('%s_%s_total%s %d' % (prefix, name, labels (label), value))
+		for (name, label), histogram in sorted (self.histograms.items ()):
+			seen = 0
+			for bound, count in zip (histogram.buckets + ('+Inf',), histogram.counts):
+				seen += count
+				lines.append ('%s_%s_bucket%s %d' % (prefix, name, labels (label, ('le', bound)), seen))
+			lines.append ('%s_%s_sum%s %f' % (prefix, name, labels (label), histogram.sum))
+			lines.append ('%s_%s_count%s %d' % (prefix, name, labels (label), histogram.count))
+		return '\n'.join (lines) + '\n'
+
+def escape (value):
+	'''
+	Escapes a label value for the Prometheus text exposition format
+	'''
+	return str (value).replace ('\\', '\\\\').replace ('"', '\\"').replace ('\n', '\\n')
+
+def listen (metrics, port, interface = '127.0.0.1'):
+	'''
+	Serves the given metrics, or those returned by a callable, over HTTP
+	in the Prometheus format, returns the listening port
+	'''
+	from twisted.internet import reactor
+	from twisted.web.resource import Resource
+	from twisted.web.server import Site
+
+	class MetricsResource (Resource):
+		isLeaf = True
+
+		def render_GET (self, request):
+			request.setHeader ('Content-Type', 'text/plain; version=0.0.4')
+			return (metrics () if callable (metrics) else metrics).prometheus ()
+
+	return reactor.listenTCP (port, Site (MetricsResource ()), interface = interface)
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import re
+
+# Global inline flags would apply to every rule of a combined pattern
+FLAGS = re.compile (r'\(\?[iLmsux]+\)')
+WORDS = re.compile (r'\w+')
+
+class PatternSet (object):
+	'''
+	I am a list of regular expressions compiled into as few combined
+	patterns as possible, so that a text is checked against every rule in a
+	single scan. Rules are referred to by their index in the list.
+	
+	Rules holding groups of their own (that might be referred to by
+	backreferences) or global flags are compiled and checked separately
+	'''
+	# Python limits the number of groups in a single pattern
+	chunk = 99
+
+	def __init__ (self, rules, flags = 0):
+		self.rules = list (rules)
+		self._combined = []
+		self._single = []
+		plain = []
+		self._compiled = [re.compile (rule, flags) for rule in self.rules]
+		for index, rule in enumerate (self.rules):
+			compiled = self._compiled[index]
+			if compiled.groups or FLAGS.search (rule):
+				self._single.append ((index, compiled))
+			else:
+				plain.append (index)
+		for start in range (0, len (plain), self.chunk):
+			indexes = plain[start:start + self.chunk]
+			pattern = '|'.join (['(%s)' % self.rules[index] for index in indexes])
+			self._combined.append ((indexes, re.compile (pattern, flags)))
+
+	def _scan (self, text, method):
+		for indexes, compiled in self._combined:
+			found = getattr (compiled, method) (text)
+			if found:
+				return indexes[found.lastindex - 1]
+		for index, compiled in self._single:
+			if getattr (compiled, method) (text):
+				return index
+		return None
+
+	def match (self, text):
+		'''
+		Returns the index of a rule matching at the beginning of the text,
+		None if no rule matches
+		'''
+		return self._scan (text, 'match')
+
+	def search (self, text):
+		'''
+		Returns the index of a rule matching anywhere in the text, None if
+		no rule matches
+		'''
+		return self._scan (text, 'search')
+
+	def findall (self, text):
+		'''
+		Returns the indexes of every rule matching anywhere in the text;
+		rules of a combined pattern are only checked one by one when the
+		combined pattern matches
+		'''
+		found = []
+		for indexes, compiled in self._combined:
+			if compiled.search (text):
+				found += [index for index in indexes if self._compiled[index].search (text)]
+		found += [index for index, compiled in self._single if compiled.search (text)]
+		return sorted (found)
+
+	def __len__ (self):
+		return len (self.rules)
+
+class KeywordSet (object):
+	'''
+	I am a list of keywords compiled into an Aho-Corasick automaton, so
+	that every keyword found in a text is reported in a single pass over
+	its characters. Keywords are matched regardless of case, as whole
+	words only unless `words` is false, and referred to by their index in
+	the list.
+	
+	Whole words keywords start with a word of the text, so texts without
+	any of these words are rejected before running the automaton
+	'''
+	def __init__ (self, keywords, words = True):
+		self.keywords = [keyword.lower () for keyword in keywords]
+		self.words = words
+		self._first = None
+		if words and all ([WORDS.match (keyword) for keyword in self.keywords]):
+			self._first = frozenset ([WORDS.match (keyword).group () for keyword in self.keywords])
+		goto, fail, output = [{}], [0], [[]]
+		for index, keyword in enumerate (self.keywords): # building the trie
+			state = 0
+			for char in keyword:
+				if not char in goto[state]:
+					goto.append ({})
+					fail.append (0)
+					output.append ([])
+					goto[state][char] = len (goto) - 1
+				state = goto[state][char]
+			output[state].append (index)
+		alphabet = set (''.join (self.keywords))
+		self._table = [dict () for state in goto]
+		queue = [0]
+		for state in queue: # breadth first, every transition is resolved
+			for char in alphabet:
+				if char in goto[state]:
+					target = goto[state][char]
+					fail[target] = self._table[fail[state]].get (char, 0) if state else 0
+					output[target] = output[target] + output[fail[target]]
+					queue.append (target)
+					self._table[state][char] = target
+				elif state:
+					following = self._table[fail[state]].get (char, 0)
+					if following:
+						self._table[state][char] = following
+		self._output = [tuple (indexes) for indexes in output]
+
+	def findall (self, text):
+		'''
+		Returns the indexes of every keyword found in the text
+		'''
+		text = text.lower ()
+		if self._first is not None and self._first.isdisjoint (WORDS.findall (text)):
+			return []
+		table, output = self._table, self._output
+		found, state = set (), 0
+		for position, char in enumerate (text):
+			state = table[state].get (char, 0)
+			if output[state]:
+				for index in output[state]:
+					if self.words:
+						start, end = position + 1 - len (self.keywords[index]), position + 1
+						if ((start and (text[start - 1].isalnum () or text[start - 1] == '_')) or
+						    (end < len (text) and (text[end].isalnum () or text[end] == '_'))):
+							continue
+					found.add (index)
+		return sorted (found)
+
+	def __len__ (self):
+		return len (self.keywords)
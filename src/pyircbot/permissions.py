@@ -17,7 +17,38 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from core import BotProtocol, botcommand
-import re
+from cache import LRUCache
+from patterns import PatternSet
+
+class PermissionEngine (object):
+	'''
+	I am the compiled form of host permissions. Commands granted to the
+	same hosts share one combined pattern, so that every command a hostmask
+	may run is found in a single pass over the rules, then cached
+	'''
+	def __init__ (self, permissions, generation, size):
+		self.permissions = permissions
+		self.generation = generation
+		groups = {}
+		for command, hosts in permissions.items ():
+			groups.setdefault (tuple (hosts), []).append (command)
+		self._groups = [(PatternSet (hosts), frozenset (commands))
+		                for hosts, commands in groups.items ()]
+		self._cache = LRUCache (size)
+
+	def commands (self, user):
+		'''
+		Returns the set of commands the given hostmask may run
+		'''
+		allowed = self._cache.get (user)
+		if allowed is None:
+			allowed = set ()
+			for patterns, commands in self._groups:
+				if not commands <= allowed and patterns.match (user) is not None:
+					allowed |= commands
+			allowed = frozenset (allowed)
+			self._cache[user] = allowed
+		return allowed
 
 class PermissionBotProtocol (BotProtocol):
 	'''
@@ -39,11 +70,35 @@ class HostPermissionBotProtocol (PermissionBotProtocol):
 	I am a bot protocol which implements a permission behavior relying on
 	the host of the user who emits the command, you just have to provide
 	me with granted hosts for every command
+	
+	Granted hosts are compiled once and decisions are cached for every
+	hostmask (up to `permissioncache` of them), so please either replace the
+	factory `permissions` dictionary or call `invalidate` on the factory
+	whenever granted hosts change
 	'''
-	def _permit (self, user, channel, command, args):	
-		if command not in self.factory.permissions:
-			return False
-		for host in self.factory.permissions[command]:
-			if re.match (host, user):
-				return True
-		return False
+	def _permissions (self):
+		'''
+		Returns the permission engine, compiled again whenever the granted
+		hosts are replaced or the factory is invalidated
+		'''
+		engine = getattr (self.factory, '_permissionengine', None)
+		if engine and not engine.permissions is self.factory.permissions:
+			self.factory.invalidate () # cached permission results are stale
+		if engine is None or not engine.generation == self.factory.generation:
+			engine = PermissionEngine (self.factory.permissions, self.factory.generation,
+			                           getattr (self.factory, 'permissioncache', 1024))
+			self.factory._permissionengine = engine
+		return engine
+
+	def _refresh (self):
+		self._permissions ()
+		super(HostPermissionBotProtocol, self)._refresh ()
+
+	def _permitted (self, user):
+		'''
+		Returns the set of every command the user may run
+		'''
+		return self._permissions ().commands (user)
+
+	def _permit (self, user, channel, command, args):
+		return command in self._permitted (user)
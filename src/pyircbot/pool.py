@@ -0,0 +1,175 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python import log
+from collections import deque
+from sandbox import native
+import signal
+import json
+import sys
+import os
+
+class SandboxError (Exception):
+	'''
+	Raised when a sandboxed evaluation fails
+	'''
+
+class SandboxWorker (ProcessProtocol):
+	'''
+	I am the link to a sandbox worker process, running one job at a time
+	'''
+	maxreply = 1 << 20
+
+	def __init__ (self, pool):
+		self.pool = pool
+		self.job = None
+		self.jobs = 0
+		self.timeout = None
+		self.killed = False
+		self._buffer = ''
+
+	def connectionMade (self):
+		self.pool._ready (self)
+
+	def run (self, request, d):
+		line = json.dumps (request, default = str, encoding = 'latin-1') + '\n'
+		self.job = d
+		self.jobs += 1
+		self.transport.write (line)
+		self.timeout = self.pool.clock.callLater (self.pool.timeout, self.kill, 'timed out')
+
+	def kill (self, reason):
+		self.killed = reason
+		self.transport.signalProcess ('KILL')
+
+	def outReceived (self, data):
+		self._buffer += data
+		if len (self._buffer) > self.maxreply and not self.killed:
+			self.kill ('reply too long')
+		while '\n' in self._buffer and not self.killed:
+			line, self._buffer = self._buffer.split ('\n', 1)
+			if self.timeout.active ():
+				self.timeout.cancel ()
+			d, self.job = self.job, None
+			self.pool._done (self, d, native (json.loads (line)))
+
+	def errReceived (self, data):
+		log.msg ('sandbox worker %s: %s' % (self.transport.pid, data.rstrip ()))
+
+	def processEnded (self, reason):
+		if self.timeout and self.timeout.active ():
+			self.timeout.cancel ()
+		if not self.killed and getattr (reason.value, 'signal', None) == signal.SIGXCPU:
+			self.killed = 'exceeded its CPU time'
+		self.pool._ended (self, self.killed or 'crashed (%s)' % reason.getErrorMessage ())
+
+class EvaluationPool (object):
+	'''
+	I am a pool of pre-forked worker processes evaluating expressions out
+	of the reactor process. Every job is limited in CPU time and memory,
+	and killed after a wall-clock timeout; workers are recycled after a
+	number of jobs. Jobs are queued until a worker is available, and
+	results are returned as Deferreds
+	'''
+	def __init__ (self, size = 2, jobs = 100, cpu = 2, memory = 128 << 20, timeout = 5, clock = reactor):
+		self.size = size
+		self.jobs = jobs
+		self.cpu = cpu
+		self.memory = memory
+		self.timeout = timeout
+		self.clock = clock
+		self.stopped = False
+		self._workers = set ()
+		self._idle = deque ()
+		self._queue = deque ()
+		for i in range (size):
+			self._spawn ()
+
+	def _spawn (self):
+		worker = SandboxWorker (self)
+		package = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+		env = dict (os.environ)
+		env['PYTHONPATH'] = os.pathsep.join ([package] + filter (None, [env.get ('PYTHONPATH')]))
+		reactor.spawnProcess (worker, sys.executable, [sys.executable, '-c',
+			'from pyircbot.sandbox import serve; serve (%d)' % self.memory], env = env)
+		self._workers.add (worker)
+
+	def evaluate (self, mode, expr, items):
+		'''
+		Evaluates an expression the way `py`, `map` or `filter` do, returns
+		a Deferred firing with the result
+		'''
+		d = Deferred ()
+		self._queue.append (({'mode': mode, 'expr': expr, 'items': items, 'cpu': self.cpu}, d))
+		self._dispatch ()
+		return d
+
+	def stop (self):
+		'''
+		Stops every worker, pending jobs fail
+		'''
+		self.stopped = True
+		while self._queue:
+			request, d = self._queue.popleft ()
+			d.errback (SandboxError ('evaluation pool stopped'))
+		for worker in list (self._workers):
+			worker.transport.closeStdin ()
+
+	def _dispatch (self):
+		while self._idle and self._queue:
+			worker = self._idle.popleft ()
+			request, d = self._queue.popleft ()
+			try:
+				worker.run (request, d)
+			except Exception:
+				worker.job = None
+				self._idle.appendleft (worker)
+				d.errback ()
+
+	def _ready (self, worker):
+		self._idle.append (worker)
+		self._dispatch ()
+
+	def _done (self, worker, d, reply):
+		if worker.jobs >= self.jobs: # recycling
+			self._workers.discard (worker)
+			worker.transport.closeStdin ()
+			if not self.stopped:
+				self._spawn ()
+		else:
+			self._idle.append (worker)
+		if 'error' in reply:
+			d.errback (SandboxError (reply['error']))
+		else:
+			d.callback (reply['result'])
+		self._dispatch ()
+
+	def _ended (self, worker, reason):
+		if worker in self._idle:
+			self._idle.remove (worker)
+		if worker in self._workers:
+			self._workers.discard (worker)
+			if not self.stopped:
+				self._spawn ()
+		if worker.job:
+			d, worker.job = worker.job, None
+			d.errback (SandboxError ('evaluation %s' % reason))
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import types
+import sys
+import os
+
+def reloadable (cls):
+	'''
+	Returns the names of the modules reloaded along with the given class:
+	every pyircbot module but the tests, and the modules of the class and its bases but
+	the main script, Twisted and the standard library
+	'''
+	names = set ([name for name, module in sys.modules.items ()
+	              if module is not None and name.startswith ('pyircbot.')
+	              and not name.startswith ('pyircbot.test')])
+	for base in cls.__mro__:
+		module = sys.modules.get (base.__module__)
+		path = getattr (module, '__file__', '') or ''
+		if (not base.__module__ in ('__main__', '__builtin__') and not base.__module__.startswith ('twisted.')
+		    and not path.startswith (sys.prefix)):
+			names.add (base.__module__)
+	return names
+
+def order (names):
+	'''
+	Sorts module names so that every module comes after the modules it
+	imports objects from
+	'''
+	ordered, visiting = [], set ()
+	def visit (name):
+		if name in visiting:
+			return
+		visiting.add (name)
+		for value in vars (sys.modules[name]).values ():
+			if (isinstance (value, (type, types.ClassType, types.FunctionType)) and
+			    getattr (value, '__module__', None) in names):
+				visit (value.__module__)
+		ordered.append (name)
+	for name in sorted (names):
+		visit (name)
+	return ordered
+
+def rebuild (cls, names):
+	'''
+	Returns the class matching the given one once the given modules are
+	reloaded: the class of the same name from its reloaded module, or a new
+	class built from the reloaded bases
+	'''
+	if cls.__module__ in names:
+		return getattr (sys.modules[cls.__module__], cls.__name__, cls)
+	bases = tuple ([rebuild (base, names) for base in cls.__bases__])
+	if bases == cls.__bases__:
+		return cls
+	attrs = dict ([(key, value) for key, value in vars (cls).items ()
+	               if not key in ('__dict__', '__weakref__', 'commands')])
+	return type (cls.__name__, bases, attrs)
+
+def source (module):
+	'''
+	Returns the path of the source file of a module, None if unknown
+	'''
+	path = getattr (module, '__file__', None)
+	if path and path[-4:] in ('.pyc', '.pyo'):
+		path = path[:-1]
+	return path if path and path.endswith ('.py') and os.path.exists (path) else None
+
+def reloadclass (*classes):
+	'''
+	Reloads the modules of the given classes, returns the rebuilt classes
+	along with the names of the reloaded modules
+	
+	Every module is compiled first, then reloaded in place; if anything
+	fails, every module already reloaded gets its former namespace back so
+	that the running classes are left untouched, and the error is raised
+	'''
+	names = set ()
+	for cls in classes:
+		names.update (reloadable (cls))
+	modules = order (names)
+	for name in modules:
+		path = source (sys.modules[name])
+		if path:
+			with open (path, 'rU') as code:
+				compile (code.read (), path, 'exec')
+	snapshots = []
+	try:
+		for name in modules:
+			module = sys.modules[name]
+			snapshots.append ((module, dict (vars (module))))
+			reload (module)
+		rebuilt = [rebuild (cls, names) for cls in classes]
+	except:
+		for module, snapshot in reversed (snapshots):
+			namespace = vars (module)
+			namespace.clear ()
+			namespace.update (snapshot)
+			sys.modules[module.__name__] = module
+		raise
+	return rebuilt, names
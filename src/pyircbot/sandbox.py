@@ -0,0 +1,116 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# This module is imported by sandboxed evaluation workers, please keep it
+# free from Twisted and other heavy dependencies
+
+from cache import LRUCache
+import resource
+import json
+import sys
+import ast
+
+# Syntax allowed in evaluated expressions, lambdas and backquotes are not
+NODES = tuple ([getattr (ast, name) for name in (
+	'Expression', 'Num', 'Str', 'Name', 'List', 'Tuple', 'Dict', 'Set',
+	'BinOp', 'UnaryOp', 'BoolOp', 'Compare', 'IfExp', 'Call', 'keyword',
+	'Attribute', 'Subscript', 'Index', 'Slice', 'ExtSlice', 'Ellipsis',
+	'ListComp', 'SetComp', 'DictComp', 'GeneratorExp', 'comprehension',
+	'NameConstant', 'Constant',
+	'expr_context', 'operator', 'boolop', 'cmpop', 'unaryop'
+) if hasattr (ast, name)])
+
+# Compiled expressions shared by every evaluating command
+expressions = LRUCache (256)
+
+def compile_expression (expr):
+	'''
+	Returns the code object evaluating the given expression, or None if
+	the expression is not considered safe. Expressions are checked and
+	compiled once, then cached
+	'''
+	code = expressions.get (expr)
+	if code is None:
+		code = False
+		if not set(':_').intersection(expr):
+			tree = ast.parse (expr, '<expression>', 'eval')
+			if all ([isinstance (node, NODES) for node in ast.walk (tree)]):
+				code = compile (tree, '<expression>', 'eval')
+		expressions[expr] = code
+	return code or None
+
+def native (value):
+	'''
+	Converts decoded JSON values back to native strings: byte strings are
+	sent as Latin-1 so that any byte goes through unchanged, and unicode
+	strings out of the Latin-1 range as UTF-8
+	'''
+	if isinstance (value, unicode):
+		try:
+			return value.encode ('latin-1')
+		except UnicodeEncodeError:
+			return value.encode ('utf-8')
+	if isinstance (value, list):
+		return [native (x) for x in value]
+	if isinstance (value, dict):
+		return dict ([(native (k), native (v)) for k, v in value.items ()])
+	return value
+
+def evaluate (mode, expr, items):
+	'''
+	Evaluates the expression the way `py`, `map` or `filter` do, depending
+	on the mode. Results of `py` are formatted as a list of strings
+	'''
+	code = compile_expression (expr)
+	namespace = {'__builtins__': None}
+	if mode == 'filter':
+		if code is None:
+			return []
+		return [x for x in items if eval (code, namespace, {'x': x})]
+	if mode == 'map':
+		if code is None:
+			return [None for x in items]
+		return [eval (code, namespace, {'x': x}) for x in items]
+	result = None if code is None else eval (code, namespace, {'x': items})
+	if type (result) is list:
+		return [str (x) for x in result]
+	return [str (result)]
+
+def serve (memory):
+	'''
+	Runs a sandbox worker: every line read from the standard input is a
+	JSON request, answered with a single JSON line. The address space is
+	limited to the given number of bytes, and every request sets the CPU
+	time it may consume
+	'''
+	if memory:
+		resource.setrlimit (resource.RLIMIT_AS, (memory, memory))
+	hard = resource.getrlimit (resource.RLIMIT_CPU)[1]
+	for line in iter (sys.stdin.readline, ''):
+		request = native (json.loads (line))
+		usage = resource.getrusage (resource.RUSAGE_SELF)
+		soft = int (usage.ru_utime + usage.ru_stime + request['cpu']) + 1
+		resource.setrlimit (resource.RLIMIT_CPU, (soft if hard == resource.RLIM_INFINITY else min (soft, hard), hard))
+		try:
+			reply = {'result': evaluate (request['mode'], request['expr'], request['items'])}
+			reply = json.dumps (reply, default = str, encoding = 'latin-1')
+		except BaseException as error:
+			reply = json.dumps ({'error': '%s: %s' % (error.__class__.__name__, error)}, encoding = 'latin-1')
+		sys.stdout.write (reply + '\n')
+		sys.stdout.flush ()
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from twisted.internet import reactor
+from collections import deque
+
+class TokenBucket (object):
+	'''
+	I am a token bucket: I hold up to `burst` tokens and I am refilled with
+	`rate` tokens every second
+	'''
+	def __init__ (self, rate, burst, clock):
+		self.rate = float (rate)
+		self.burst = burst
+		self.tokens = burst
+		self.clock = clock
+		self.stamp = clock ()
+
+	def _refill (self):
+		now = self.clock ()
+		self.tokens = min (self.burst, self.tokens + (now - self.stamp) * self.rate)
+		self.stamp = now
+
+	def consume (self, tokens = 1):
+		'''
+		Takes the given tokens if available, returns whether it did
+		'''
+		self._refill ()
+		if self.tokens >= tokens:
+			self.tokens -= tokens
+			return True
+		return False
+
+	def delay (self, tokens = 1):
+		'''
+		Returns the number of seconds before the given tokens are available
+		'''
+		self._refill ()
+		return max (0, (tokens - self.tokens) / self.rate)
+
+class OutboundScheduler (object):
+	'''
+	I am an outbound line scheduler. Lines are written as long as my token
+	bucket allows it, then queued until tokens are available again.
+	
+	Urgent lines always go first, then lines pushed without a target,
+	which are protocol traffic; other lines are queued per target, and
+	targets are served in a round-robin fashion so that a long output to
+	one channel never holds up replies to the others. A rate of 0 means no
+	limit at all
+	'''
+	def __init__ (self, write, rate, burst, clock = reactor):
+		self.write = write
+		self.clock = clock
+		self.bucket = TokenBucket (rate, burst, clock.seconds) if rate else None
+		self._urgent = deque ()
+		self._protocol = deque ()
+		self._targets = {}
+		self._rounds = deque ()
+		self._call = None
+		self.sent = 0
+		self.waited = 0.0
+		self.maxwait = 0.0
+
+	@property
+	def depth (self):
+		'''
+		Number of queued lines
+		'''
+		return len (self._urgent) + len (self._protocol) + sum ([len (x) for x in self._targets.values ()])
+
+	def stats (self):
+		'''
+		Returns a dictionary describing the current queue and waiting times
+		'''
+		now = self.clock.seconds ()
+		oldest = [x[0][0] for x in self._targets.values () + [self._urgent, self._protocol] if x]
+		return {
+			'depth': self.depth,
+			'urgent': len (self._urgent),
+			'protocol': len (self._protocol),
+			'targets': len (self._targets),
+			'sent': self.sent,
+			'meanwait': self.waited / self.sent if self.sent else 0.0,
+			'maxwait': self.maxwait,
+			'oldest': now - min (oldest) if oldest else 0.0,
+		}
+
+	def push (self, line, target = None, urgent = False):
+		'''
+		Queues a line for the given target, None for protocol traffic
+		'''
+		entry = (self.clock.seconds (), line)
+		if urgent:
+			self._urgent.append (entry)
+		elif target is None:
+			self._protocol.append (entry)
+		else:
+			queue = self._targets.get (target)
+			if queue is None:
+				queue = self._targets[target] = deque ()
+				self._rounds.append (target)
+			queue.append (entry)
+		if self._call is None:
+			self._pump ()
+
+	def stop (self):
+		'''
+		Drops every queued line
+		'''
+		if self._call is not None:
+			self._call.cancel ()
+			self._call = None
+		self._urgent.clear ()
+		self._protocol.clear ()
+		self._targets.clear ()
+		self._rounds.clear ()
+
+	def _next (self):
+		if self._urgent:
+			return self._urgent.popleft ()
+		if self._protocol:
+			return self._protocol.popleft ()
+		target = self._rounds.popleft ()
+		queue = self._targets[target]
+		entry = queue.popleft ()
+		if queue:
+			self._rounds.append (target)
+		else:
+			del self._targets[target]
+		return entry
+
+	def _wake (self):
+		self._call = None
+		self._pump ()
+
+	def _pump (self):
+		while (self._urgent or self._protocol or self._rounds) and (self.bucket is None or self.bucket.consume ()):
+			stamp, line = self._next ()
+			wait = self.clock.seconds () - stamp
+			self.sent += 1
+			self.waited += wait
+			self.maxwait = max (self.maxwait, wait)
+			self.write (line)
+		if self._urgent or self._protocol or self._rounds:
+			self._call = self.clock.callLater (self.bucket.delay (), self._wake)
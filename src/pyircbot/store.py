@@ -0,0 +1,121 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from twisted.internet.defer import succeed
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+import threading
+import sqlite3
+
+class SQLiteAliasStore (object):
+	'''
+	I am an alias store backed by a SQLite database in WAL mode. I behave
+	like a dictionary: every alias is loaded in memory at once, then only
+	changed aliases are written back by `sync`, from a thread so that disk
+	access never blocks the reactor.
+	
+	Any object providing the same dictionary methods along with `sync` and
+	`close` might be used as an alias store instead
+	'''
+	def __init__ (self, path):
+		self.path = path
+		self._dirty = {}
+		self._flushing = None
+		self._lock = threading.Lock ()
+		self._connection = sqlite3.connect (path, check_same_thread = False)
+		self._connection.text_factory = str
+		self._connection.execute ('PRAGMA journal_mode=WAL')
+		self._connection.execute ('PRAGMA synchronous=NORMAL')
+		self._connection.execute ('CREATE TABLE IF NOT EXISTS aliases '
+		                          '(name TEXT PRIMARY KEY, command TEXT NOT NULL)')
+		self._connection.commit ()
+		self._data = dict (self._connection.execute ('SELECT name, command FROM aliases'))
+
+	def _write (self, dirty):
+		'''
+		Writes the given changes, deleted aliases being mapped to None
+		'''
+		with self._lock:
+			with self._connection:
+				self._connection.executemany ('INSERT OR REPLACE INTO aliases VALUES (?, ?)',
+					[(name, command) for name, command in dirty.items () if command is not None])
+				self._connection.executemany ('DELETE FROM aliases WHERE name = ?',
+					[(name,) for name, command in dirty.items () if command is None])
+
+	def _written (self, result, dirty):
+		self._flushing = None
+		if result is not None: # keeping changes for the next attempt
+			for name, command in dirty.items ():
+				self._dirty.setdefault (name, command)
+			log.err (result, 'Could not write aliases to %s' % self.path)
+
+	def sync (self):
+		'''
+		Writes changed aliases from a thread, returns a Deferred fired once
+		they are written. Only one write happens at a time
+		'''
+		if self._flushing or not self._dirty:
+			return self._flushing or succeed (None)
+		dirty, self._dirty = self._dirty, {}
+		self._flushing = deferToThread (self._write, dirty)
+		self._flushing.addCallbacks (lambda result: self._written (None, dirty),
+		                             lambda failure: self._written (failure, dirty))
+		return self._flushing
+
+	def close (self):
+		'''
+		Synchronously writes remaining changes and closes the database
+		'''
+		if self._connection is None:
+			return
+		dirty, self._dirty = self._dirty, {}
+		self._write (dirty)
+		with self._lock:
+			self._connection.close ()
+			self._connection = None
+
+	def __getitem__ (self, name):
+		return self._data[name]
+
+	def __setitem__ (self, name, command):
+		self._data[name] = command
+		self._dirty[name] = command
+
+	def __delitem__ (self, name):
+		del self._data[name]
+		self._dirty[name] = None
+
+	def __contains__ (self, name):
+		return name in self._data
+
+	def __len__ (self):
+		return len (self._data)
+
+	def get (self, name, default = None):
+		return self._data.get (name, default)
+
+	def keys (self):
+		return self._data.keys ()
+
+	def items (self):
+		return self._data.items ()
+
+	def update (self, other):
+		for name, command in other.items ():
+			self[name] = command
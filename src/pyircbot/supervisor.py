@@ -0,0 +1,277 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Runs the same bot on several networks, one worker process per network or
+# shard of channels, from a single JSON configuration such as:
+#
+# {
+#   "factory": "mybot.MyBotFactory",
+#   "nickname": "pyircbot", "bang": "!", "pipe": "->",
+#   "settings": {"debug": false},
+#   "metricsport": 9100,
+#   "networks": {
+#     "freenode": {"host": "irc.freenode.net", "port": 6667,
+#                  "channels": ["#a", "#b", "#c"], "shards": 2},
+#     "oftc": {"host": "irc.oftc.net", "channels": ["#d"], "nickname": "other"}
+#   }
+# }
+#
+# Network entries override the global values. Shards split the channels of
+# a network between workers, every shard but the first one has its index
+# appended to the nickname. Start the supervisor with:
+#
+#   python -m pyircbot.supervisor bots.json
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.stdio import StandardIO
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+from metrics import Metrics, listen
+from sandbox import native
+import json
+import sys
+import os
+
+def workers (config):
+	'''
+	Returns the specification of every worker described by a configuration
+	'''
+	specs = []
+	for network, settings in sorted (config['networks'].items ()):
+		spec = dict ((key, value) for key, value in config.items () if not key in ('networks', 'metricsport'))
+		spec.update (settings)
+		spec.setdefault ('port', 6667)
+		spec.setdefault ('password', None)
+		spec['settings'] = dict (config.get ('settings', {}), **settings.get ('settings', {}))
+		shards = spec.pop ('shards', 1)
+		channels = spec.get ('channels', [])
+		for shard in range (shards):
+			worker = dict (spec, name = network if shards == 1 else '%s/%d' % (network, shard))
+			worker['channels'] = channels[shard::shards]
+			if shard:
+				worker['nickname'] = '%s%d' % (spec['nickname'], shard)
+			specs.append (worker)
+	return specs
+
+class WorkerControl (LineReceiver):
+	'''
+	I am the worker side of the control channel, speaking JSON lines with
+	the supervisor over the standard input and output. Bot protocols find
+	me as the factory `control` and forward `stop` and `debug` through me
+	so that they apply to every worker
+	'''
+	delimiter = '\n'
+
+	def __init__ (self, factory, interval = 10):
+		self.factory = factory
+		self._report = LoopingCall (self.report)
+		self._interval = interval
+
+	def connectionMade (self):
+		self._report.start (self._interval, now = False)
+
+	def connectionLost (self, reason):
+		if self._report.running:
+			self._report.stop ()
+		if reactor.running: # the supervisor is gone
+			reactor.stop ()
+
+	def send (self, command, **kwargs):
+		'''
+		Sends a control command to the supervisor
+		'''
+		kwargs['command'] = command
+		self.sendLine (json.dumps (kwargs))
+
+	def report (self):
+		'''
+		Sends the factory metrics to the supervisor
+		'''
+		self.send ('metrics', metrics = self.factory.metrics.dump ())
+
+	def lineReceived (self, line):
+		message = native (json.loads (line))
+		if message['command'] == 'stop':
+			self.report ()
+			reactor.stop ()
+		elif message['command'] == 'debug':
+			self.factory.debug = message['value']
+
+class WorkerProcess (ProcessProtocol):
+	'''
+	I am the supervisor side of a worker process
+	'''
+	def __init__ (self, supervisor, spec):
+		self.supervisor = supervisor
+		self.spec = spec
+		self.started = supervisor.clock.seconds ()
+		self.metrics = None
+		self._buffer = ''
+
+	def send (self, command, **kwargs):
+		kwargs['command'] = command
+		self.transport.write (json.dumps (kwargs) + '\n')
+
+	def outReceived (self, data):
+		self._buffer += data
+		while '\n' in self._buffer:
+			line, self._buffer = self._buffer.split ('\n', 1)
+			try:
+				message = native (json.loads (line))
+			except ValueError:
+				log.msg ('worker %s: %s' % (self.spec['name'], line))
+				continue
+			self.supervisor._received (self, message)
+
+	def processEnded (self, reason):
+		self.supervisor._ended (self, reason)
+
+class Supervisor (object):
+	'''
+	I start and watch a worker process for every network or shard of a
+	configuration. Crashed workers are restarted after a delay doubling
+	from `delay` up to `maxdelay`, reset once a worker ran for `stable`
+	seconds. Control commands from a worker are broadcast to every worker,
+	and their metrics are aggregated
+	'''
+	delay = 1
+	maxdelay = 300
+	stable = 60
+
+	def __init__ (self, config, clock = reactor):
+		self.specs = workers (config)
+		self.clock = clock
+		self.stopping = False
+		self._halt = False
+		self._workers = {}
+		self._failures = {}
+		self._retired = Metrics ()
+
+	def start (self):
+		for spec in self.specs:
+			self._spawn (spec)
+
+	def _spawn (self, spec):
+		if self.stopping:
+			return
+		worker = WorkerProcess (self, spec)
+		package = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+		env = dict (os.environ)
+		env['PYTHONPATH'] = os.pathsep.join ([package, os.getcwd ()] + filter (None, [env.get ('PYTHONPATH')]))
+		reactor.spawnProcess (worker, sys.executable, [sys.executable, '-c',
+			'from pyircbot.supervisor import work; work ()', json.dumps (spec)],
+			env = env, childFDs = {0: 'w', 1: 'r', 2: 2})
+		self._workers[spec['name']] = worker
+
+	def broadcast (self, command, **kwargs):
+		'''
+		Sends a control command to every running worker
+		'''
+		for worker in self._workers.values ():
+			worker.send (command, **kwargs)
+
+	def metrics (self):
+		'''
+		Returns the metrics aggregated from every worker, past and present
+		'''
+		metrics = Metrics ()
+		metrics.merge (self._retired.dump ())
+		for worker in self._workers.values ():
+			if worker.metrics:
+				metrics.merge (worker.metrics)
+		return metrics
+
+	def stop (self, halt = True):
+		'''
+		Stops every worker, then the reactor unless `halt` is false
+		'''
+		if not self.stopping:
+			self.stopping = True
+			self.broadcast ('stop')
+		self._halt = halt
+		self._halted ()
+
+	def _halted (self):
+		if self._halt and not self._workers:
+			self._halt = False
+			reactor.stop ()
+
+	def _received (self, worker, message):
+		if message['command'] == 'metrics':
+			worker.metrics = message['metrics']
+		elif message['command'] == 'stop':
+			log.msg ('worker %s requested to stop' % worker.spec['name'])
+			self.stop ()
+		elif message['command'] == 'debug':
+			for spec in self.specs: # restarted workers keep the flag
+				spec['settings']['debug'] = message['value']
+			self.broadcast ('debug', value = message['value'])
+
+	def _ended (self, worker, reason):
+		name = worker.spec['name']
+		if self._workers.get (name) is worker:
+			del self._workers[name]
+		if worker.metrics:
+			self._retired.merge (worker.metrics)
+		if self.stopping:
+			self._halted ()
+			return
+		if self.clock.seconds () - worker.started >= self.stable:
+			self._failures[name] = 0
+		failures = self._failures.get (name, 0)
+		self._failures[name] = failures + 1
+		delay = min (self.maxdelay, self.delay * 2 ** failures)
+		log.msg ('worker %s ended (%s), restarting in %gs' % (name, reason.getErrorMessage (), delay))
+		self.clock.callLater (delay, self._spawn, worker.spec)
+
+def work (spec = None):
+	'''
+	Runs a single worker from its specification
+	'''
+	spec = native (json.loads (spec or sys.argv[1]))
+	log.startLogging (sys.stderr)
+	sys.stdout = sys.stderr # the standard output is the control channel
+	module, name = spec['factory'].rsplit ('.', 1)
+	factory = getattr (__import__ (module, fromlist = [name]), name) (
+		spec['nickname'], spec['password'], spec['channels'], spec['bang'], spec['pipe'])
+	for key, value in spec['settings'].items ():
+		setattr (factory, key, value)
+	factory.control = WorkerControl (factory, spec.get ('report', 10))
+	StandardIO (factory.control)
+	reactor.connectTCP (spec['host'], spec['port'], factory)
+	reactor.run ()
+
+def main (argv):
+	'''
+	Runs a supervisor from a configuration file
+	'''
+	with open (argv[0]) as config:
+		config = native (json.load (config))
+	log.startLogging (sys.stderr)
+	supervisor = Supervisor (config)
+	if config.get ('metricsport'):
+		listen (supervisor.metrics, config['metricsport'])
+	reactor.callWhenRunning (supervisor.start)
+	reactor.addSystemEventTrigger ('before', 'shutdown', supervisor.stop, False)
+	reactor.run ()
+
+if __name__ == '__main__':
+	main (sys.argv[1:])
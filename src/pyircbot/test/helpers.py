@@ -0,0 +1,65 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Helpers connecting bot protocols to a recording loopback IRC server
+
+from pyircbot.core import BotFactory
+from pyircbot.loopback import LoopbackServer
+from twisted.internet.task import Clock
+
+class RecordingServer (LoopbackServer):
+	'''
+	I am a loopback server keeping every line sent by the bot
+	'''
+	def __init__ (self, protocol, members = 5):
+		LoopbackServer.__init__ (self, protocol, members)
+		self.sent = []
+
+	def received (self, line):
+		self.sent.append (line)
+		LoopbackServer.received (self, line)
+
+	def say (self, user, channel, message):
+		'''
+		Sends a message to the bot, returns the messages and notices it
+		sent back meanwhile
+		'''
+		start = len (self.sent)
+		self.send (':%s PRIVMSG %s :%s' % (user, channel, message))
+		return [line for line in self.sent[start:] if line.split (' ', 1)[0] in ('PRIVMSG', 'NOTICE')]
+
+def connect (protocol, **settings):
+	'''
+	Connects a new instance of the given protocol class to a recording
+	server, without heartbeat, with a factory using a fake clock, an in-memory alias store,
+	no sandbox process and the given settings
+	'''
+	factory = BotFactory ('bot', None, ['#test'], '!', '->')
+	factory.clock = Clock ()
+	factory.aliasdb = ':memory:'
+	factory.sandboxworkers = 0
+	for key, value in settings.items ():
+		setattr (factory, key, value)
+	factory.protocol = protocol
+	bot = protocol ()
+	bot.factory = factory
+	bot.heartbeatInterval = None
+	server = RecordingServer (bot)
+	server.connect ()
+	return server
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from pyircbot.behavior import AsynchronousCallBotProtocol
+from pyircbot.test.helpers import connect
+from twisted.internet.defer import TimeoutError
+from twisted.trial import unittest
+
+class AsynchronousCallTest (unittest.TestCase):
+	'''
+	I check that replies from actors are given to the right request
+	'''
+	def setUp (self):
+		self.server = connect (AsynchronousCallBotProtocol, sync = {'Serv': (['go'], 'END')}, synctimeout = 10)
+		self.bot = self.server.protocol
+
+	def reply (self, *lines):
+		for line in lines:
+			self.server.send (':Serv!s@services PRIVMSG bot :%s' % line)
+
+	def test_expired (self):
+		first, second = [], []
+		self.assertFailure (self.bot._addjob ('Serv', 'first'), TimeoutError).addCallback (first.append)
+		self.bot.factory.clock.advance (10)
+		self.assertEqual (len (first), 1)
+		self.bot._addjob ('Serv', 'second').addCallback (second.append)
+		self.reply ('late', 'END', 'answer', 'END')
+		self.assertEqual (second, [['answer']])
+
+	def test_cancelled (self):
+		result = []
+		first = self.bot._addjob ('Serv', 'first')
+		first.addErrback (lambda failure: None)
+		first.cancel ()
+		self.bot._addjob ('Serv', 'second').addCallback (result.append)
+		self.reply ('late', 'END', 'answer', 'END')
+		self.assertEqual (result, [['answer']])
+		self.assertEqual (self.bot._syncstats ('Serv')['running'], 0)
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from pyircbot.behavior import AdmissionBotProtocol, AsynchronousCallBotProtocol
+from pyircbot.evaluation import ListBulkingBotProtocol
+from pyircbot.metrics import Metrics
+from pyircbot.test.helpers import connect
+from twisted.trial import unittest
+
+class Stack (AdmissionBotProtocol, AsynchronousCallBotProtocol, ListBulkingBotProtocol):
+	pass
+
+class AdmissionTest (unittest.TestCase):
+	'''
+	I check that commands are admitted fairly and cheaply
+	'''
+	def test_expensive (self):
+		server = connect (Stack, admissionnotice = 1, sync = {})
+		user = 'user!u@host'
+		self.assertEqual (len (server.say (user, '#test', '!cat a b->mass echo ?')), 2)
+		self.assertEqual (server.say (user, '#test', '!cat a b->mass echo ?'),
+		                  ['NOTICE user :Too many commands, please wait 10 seconds'])
+		server.protocol.factory.clock.advance (10)
+		self.assertEqual (len (server.say (user, '#test', '!cat a b->mass echo ?')), 2)
+
+	def test_unknown (self):
+		server = connect (Stack, sync = {})
+		factory = server.protocol.factory
+		plans = len (server.protocol._plans)
+		for i in range (100):
+			server.say ('user!u@host', '#test', '!junk%d" x' % i)
+		counters = [label for name, label in factory.metrics.counters if name == 'rejected']
+		self.assertEqual (counters, [('command', 'unknown')])
+		self.assertEqual (factory.metrics.counters[('rejected', ('command', 'unknown'))], 90)
+		self.assertEqual (len (server.protocol._plans), plans + 10)
+
+	def test_actors (self):
+		server = connect (Stack, sync = {'Serv': (['go'], 'END')})
+		replies = []
+		server.protocol._addjob ('Serv', 'hello').addCallback (replies.append)
+		for i in range (15):
+			server.send (':Serv!s@services PRIVMSG bot :line %d' % i)
+		server.send (':Serv!s@services PRIVMSG bot :END')
+		self.assertEqual (replies, [['line %d' % i for i in range (15)]])
+		self.assertFalse ([line for line in server.sent if line.startswith ('NOTICE')])
+
+	def test_escape (self):
+		metrics = Metrics ()
+		metrics.count ('rejected', ('command', 'a"b\\c\nd'))
+		self.assertEqual (metrics.prometheus (), 'pyircbot_rejected_total{command="a\\"b\\\\c\\nd"} 1\n')
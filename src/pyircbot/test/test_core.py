@@ -0,0 +1,135 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from pyircbot.core import BotProtocol, botcommand
+from pyircbot.basics import HelpBotProtocol
+from pyircbot.utils import WhoBotProtocol
+from pyircbot.evaluation import ListBulkingBotProtocol
+from pyircbot.permissions import HostPermissionBotProtocol
+from pyircbot.test.helpers import connect
+from twisted.trial import unittest
+import threading
+import time
+
+class Stack (BotProtocol):
+	@botcommand
+	def produce (self, flow, out, user, channel):
+		def items ():
+			for i in range (3):
+				self.threads.append (threading.current_thread ())
+				yield i
+		return items ()
+
+	@botcommand
+	def slow (self, flow, out, user, channel):
+		def items ():
+			for i in range (3):
+				time.sleep (0.01)
+				yield i
+		return items ()
+
+	@botcommand
+	def double (self, flow, out, user, channel):
+		return (x * 2 for x in flow)
+
+	@botcommand (blocking = True)
+	def consume (self, flow, out, user, channel):
+		return [x * 2 for x in flow]
+
+class OffloadTest (unittest.TestCase):
+	'''
+	I check that blocking commands run in threads, and only them
+	'''
+	def test_lazy_flow (self):
+		server = connect (Stack)
+		server.protocol.threads = []
+		d = server.protocol._handle ('user!u@host', '#test', 'produce->consume')
+		d.callback (None)
+		def check (result):
+			self.assertEqual (result, [0, 2, 4])
+			self.assertEqual (set (server.protocol.threads), set ([threading.current_thread ()]))
+		return d.addCallback (check)
+
+class LatencyTest (unittest.TestCase):
+	'''
+	I check that lazy commands are timed while their items are pulled
+	'''
+	def test_lazy (self):
+		server = connect (Stack)
+		metrics = server.protocol.factory.metrics
+		d = server.protocol._handle ('user!u@host', '#test', 'slow->double')
+		d.callback (None)
+		result = []
+		d.addCallback (result.append)
+		self.assertNotIn (('latency_seconds', ('command', 'slow')), metrics.histograms)
+		self.assertEqual (list (result[0]), [0, 2, 4])
+		slow = metrics.histograms[('latency_seconds', ('command', 'slow'))]
+		double = metrics.histograms[('latency_seconds', ('command', 'double'))]
+		self.assertTrue (slow.sum >= 0.03)
+		self.assertTrue (double.sum < 0.01)
+
+class ArityTest (unittest.TestCase):
+	'''
+	I check that calls with a wrong number of arguments are refused early
+	'''
+	def test_usage (self):
+		server = connect (type ('Stack', (HelpBotProtocol, WhoBotProtocol), {}))
+		lines = server.say ('user!u@host', '#test', '!who')
+		self.assertEqual (len (self.flushLoggedErrors (TypeError)), 1)
+		self.assertEqual (lines[0], 'PRIVMSG #test : \x02Error\x02: who takes 1 argument')
+		self.assertEqual (lines[1], 'PRIVMSG #test : \x02who\x02 <channel>')
+		self.assertFalse ([line for line in server.sent if line.startswith ('WHO ')])
+
+class JoinTest (unittest.TestCase):
+	'''
+	I check that channels are joined by batches, and joined again with
+	their keys after a reconnection
+	'''
+	def test_batches (self):
+		channels = ['#chan%d' % i for i in range (25)]
+		server = connect (BotProtocol, channels = channels, joinbatch = 10)
+		joins = [line for line in server.sent if line.startswith ('JOIN ')]
+		self.assertEqual ([len (line.split (' ')[1].split (',')) for line in joins], [10, 10, 5])
+		self.assertEqual (sorted (server.protocol.factory.joined), sorted (channels))
+
+	def test_resume (self):
+		server = connect (BotProtocol, joinwait = 5)
+		factory = server.protocol.factory
+		factory.joined['#secret'] = ('#secret', 'key')
+		bot = BotProtocol ()
+		bot.factory = factory
+		bot.heartbeatInterval = None
+		server = type (server) (bot)
+		server.connect ()
+		self.assertIn ('JOIN #secret,#test key', server.sent)
+
+class CapabilityTest (unittest.TestCase):
+	'''
+	I check that help only lists the commands a user may run
+	'''
+	def test_help (self):
+		stack = type ('Stack', (HostPermissionBotProtocol, HelpBotProtocol, ListBulkingBotProtocol), {})
+		server = connect (stack, permissions = {'help': ['.*'], 'cat': ['admin!.*']})
+		self.assertEqual (server.say ('user!u@host', '#test', '!help'),
+		                  ['PRIVMSG #test : \x02Available commands:\x02 help'])
+		self.assertEqual (server.say ('admin!a@host', '#test', '!help'),
+		                  ['PRIVMSG #test : \x02Available commands:\x02 cat, help'])
+		server.protocol.factory.permissions = {'help': ['.*'], 'echo': ['.*']}
+		self.assertEqual (server.say ('user!u@host', '#test', '!help'),
+		                  ['PRIVMSG #test : \x02Available commands:\x02 echo, help'])
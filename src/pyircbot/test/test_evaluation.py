@@ -0,0 +1,70 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from pyircbot.core import botcommand
+from pyircbot.evaluation import ListBulkingBotProtocol
+from pyircbot.test.helpers import connect
+from twisted.internet.defer import Deferred
+from twisted.trial import unittest
+
+def broken (item):
+	yield item
+	raise ValueError ('broken %s' % item)
+
+class Stack (ListBulkingBotProtocol):
+	@botcommand
+	def lazy (self, flow, out, user, channel, item):
+		return broken (item)
+
+	@botcommand
+	def slow (self, flow, out, user, channel, item):
+		out.append ('late %s' % item)
+		self.pending.append (Deferred ())
+		return self.pending[-1]
+
+class MassTest (unittest.TestCase):
+	'''
+	I check that mass calls always finish, and finish once
+	'''
+	def setUp (self):
+		self.server = connect (Stack, massdeadline = 5)
+		self.bot = self.server.protocol
+		self.bot.pending = []
+
+	def test_lazy_error (self):
+		d = self.bot.mass (['a', 'b'], [], 'user!u@host', '#test', 'lazy', '?')
+		return self.assertFailure (d, ValueError)
+
+	def test_deadline (self):
+		results = []
+		self.bot.mass (['a', 'b'], [], 'user!u@host', '#test', 'slow', '?').addCallback (results.append)
+		self.bot.factory.clock.advance (5)
+		self.assertEqual (results, [[]])
+		start = len (self.server.sent)
+		for d in self.bot.pending:
+			d.callback (['result'])
+		self.assertEqual (self.server.sent[start:], [])
+
+	def test_results (self):
+		results = []
+		self.bot.mass (['a', 'b'], [], 'user!u@host', '#test', 'slow', '?').addCallback (results.append)
+		for d in self.bot.pending:
+			d.callback (['result'])
+		self.assertEqual (results, [['result', 'result']])
+		self.assertEqual (len ([line for line in self.server.sent if 'late' in line]), 2)
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from pyircbot.history import History, HistoryBotProtocol
+from pyircbot.utils import WhoBotProtocol
+from pyircbot.test.helpers import connect
+from twisted.trial import unittest
+import os
+
+class Stack (HistoryBotProtocol, WhoBotProtocol):
+	pass
+
+class HistoryTest (unittest.TestCase):
+	'''
+	I check the history index and who may read it
+	'''
+	def setUp (self):
+		self.path = self.mktemp ()
+
+	def test_segments (self):
+		history = History (self.path, segment = 10)
+		for i in range (35):
+			history.add (i, '#test', 'nick%d' % (i % 3), 'message number %d' % i)
+		self.assertEqual ([message[0] for message in history.search ('message', limit = 5)], range (34, 29, -1))
+		history.close ()
+		self.assertEqual (len ([name for name in os.listdir (self.path) if name.endswith ('.terms')]), 3)
+		history = History (self.path, segment = 10)
+		self.assertEqual (len (history.search ('message')), 35)
+		self.assertEqual (history.seen ('nick1')[0], 34)
+		history.close ()
+
+	def test_torn (self):
+		history = History (self.path)
+		history.add (1, '#test', 'nick', 'complete line')
+		history.close ()
+		with open (os.path.join (self.path, 'messages'), 'ab') as messages:
+			messages.write ('2\t#test\tnick')
+		history = History (self.path)
+		history.add (3, '#test', 'nick', 'another line')
+		self.assertEqual ([message[0] for message in history.search ('line')], [3, 1])
+		history.close ()
+
+	def test_private (self):
+		server = connect (Stack, historypath = self.path)
+		self.addCleanup (lambda: server.protocol.factory._history.close ())
+		server.send (':alice!a@host PRIVMSG #test :hello world')
+		server.send (':bob!b@host PRIVMSG #secret :hello secret world')
+		self.assertIn ('#test <alice> hello world', server.say ('user0!u@host', 'bot', 'seen alice')[0])
+		self.assertEqual (server.say ('user0!u@host', 'bot', 'seen bob'), ['PRIVMSG user0 : I have never seen bob'])
+		self.assertIn ('seen only searches', server.say ('stranger!s@host', 'bot', 'seen alice')[0])
+		self.assertEqual (server.say ('user0!u@host', '#test', '!seen bob'), ['PRIVMSG #test : I have never seen bob'])
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from pyircbot.logsink import LogSink
+from twisted.trial import unittest
+import marshal
+import json
+import os
+
+class LogSinkTest (unittest.TestCase):
+	'''
+	I check that every record makes it to the log file
+	'''
+	def setUp (self):
+		self.path = os.path.join (self.mktemp (), 'log')
+		os.makedirs (os.path.dirname (self.path))
+
+	def test_json (self):
+		sink = LogSink (self.path)
+		sink.put ('incoming', 'user!u@host', '#test', 'caf\xc3\xa9')
+		sink.put ('incoming', 'user!u@host', '#test', 'caf\xe9')
+		sink.put ('command', 'cat', ['a', '\xff'])
+		sink.close ()
+		with open (self.path) as log:
+			records = [json.loads (line) for line in log]
+		self.assertEqual ([record.get ('message') for record in records[:2]], [u'caf\xe9', u'caf\ufffd'])
+		self.assertEqual (records[2]['args'], [u'a', u'\ufffd'])
+		self.assertEqual ((sink.written, sink.failed), (3, 0))
+
+	def test_unformattable (self):
+		sink = LogSink (self.path)
+		sink.put ('incoming', 'user!u@host', '#test', 'before')
+		sink.put ('incoming', 'user!u@host', '#test', object ())
+		sink.put ('incoming', 'user!u@host', '#test', 'after')
+		sink.close ()
+		self.assertEqual (len (self.flushLoggedErrors (TypeError)), 1)
+		with open (self.path) as log:
+			self.assertEqual ([json.loads (line)['message'] for line in log], ['before', 'after'])
+		self.assertEqual ((sink.written, sink.failed), (2, 1))
+
+	def test_marshal (self):
+		sink = LogSink (self.path, format = 'marshal')
+		sink.put ('outgoing', '#test', 'caf\xe9')
+		sink.close ()
+		with open (self.path, 'rb') as log:
+			self.assertEqual (marshal.load (log)[1:], ('outgoing', '#test', 'caf\xe9'))
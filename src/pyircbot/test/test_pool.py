@@ -0,0 +1,55 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from pyircbot.pool import EvaluationPool
+from twisted.internet import reactor, task
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+class Unprintable (object):
+	def __str__ (self):
+		raise ValueError ('unprintable')
+
+class EvaluationPoolTest (unittest.TestCase):
+	'''
+	I check that sandbox workers survive any input
+	'''
+	def setUp (self):
+		self.pool = EvaluationPool (1)
+
+	@inlineCallbacks
+	def tearDown (self):
+		self.pool.stop ()
+		while self.pool._workers:
+			yield task.deferLater (reactor, 0.01, lambda: None)
+
+	@inlineCallbacks
+	def test_bytes (self):
+		result = yield self.pool.evaluate ('map', 'x + "!"', ['\xe9t\xe9', 'caf\xc3\xa9'])
+		self.assertEqual (result, ['\xe9t\xe9!', 'caf\xc3\xa9!'])
+		result = yield self.pool.evaluate ('py', '"\xe9"', [])
+		self.assertEqual (result, ['\xe9'])
+
+	@inlineCallbacks
+	def test_unserializable (self):
+		for i in range (3):
+			yield self.assertFailure (self.pool.evaluate ('map', 'x', [Unprintable ()]), ValueError)
+		self.assertEqual (len (self.pool._idle), 1)
+		result = yield self.pool.evaluate ('filter', 'x > 1', [1, 2, 3])
+		self.assertEqual (result, [2, 3])
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, sys
+from pyircbot import core
+from pyircbot.test.helpers import connect
+from twisted.trial import unittest
+
+STACK = '''
+from pyircbot.basics import ReloadBotProtocol
+from pyircbot.evaluation import ListBulkingBotProtocol
+
+class Stack (ReloadBotProtocol, ListBulkingBotProtocol):
+	pass
+'''
+
+class ReloadTest (unittest.TestCase):
+	'''
+	I check that reloading is restricted and never leaves the bot broken
+	'''
+	def setUp (self):
+		self.path = self.mktemp ()
+		os.makedirs (self.path)
+		sys.path.insert (0, self.path)
+		self.write (STACK)
+		import reloadstack
+		self.module = reloadstack
+
+	def tearDown (self):
+		sys.path.remove (self.path)
+		sys.modules.pop ('reloadstack', None)
+
+	def write (self, code):
+		with open (os.path.join (self.path, 'reloadstack.py'), 'w') as module:
+			module.write (code)
+		for compiled in ('reloadstack.pyc', 'reloadstack.pyo'):
+			if os.path.exists (os.path.join (self.path, compiled)):
+				os.remove (os.path.join (self.path, compiled))
+
+	def test_denied (self):
+		server = connect (self.module.Stack)
+		self.assertEqual (server.say ('admin!a@host', '#test', '!reload'), [])
+
+	def test_failure (self):
+		server = connect (self.module.Stack, reloaders = ['admin!'])
+		protocol = core.BotProtocol
+		self.write (STACK + '\nraise ValueError ("broken")\n')
+		lines = server.say ('admin!a@host', '#test', '!reload')
+		self.assertEqual (len (self.flushLoggedErrors (ValueError)), 1)
+		self.assertIn ('reload failed, broken', lines[0])
+		self.assertIs (core.BotProtocol, protocol)
+		self.assertIsInstance (server.protocol, self.module.Stack)
+		self.assertEqual (server.say ('user!u@host', '#test', '!cat a b->echo'),
+		                  ['PRIVMSG #test : \x02Output:\x02 a, b'])
+
+	def test_syntax_error (self):
+		server = connect (self.module.Stack, reloaders = ['admin!'])
+		self.write (STACK + '\ndef (:\n')
+		lines = server.say ('admin!a@host', '#test', '!reload')
+		self.assertEqual (len (self.flushLoggedErrors (SyntaxError)), 1)
+		self.assertIn ('reload failed', lines[0])
+		self.assertEqual (server.say ('user!u@host', '#test', '!cat a->echo'),
+		                  ['PRIVMSG #test : \x02Output:\x02 a'])
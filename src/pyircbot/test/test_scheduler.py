@@ -0,0 +1,47 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from pyircbot.behavior import FloodControlBotProtocol
+from pyircbot.test.helpers import connect
+from twisted.trial import unittest
+
+class FloodControlTest (unittest.TestCase):
+	'''
+	I check the order in which queued lines are sent
+	'''
+	def test_lanes (self):
+		server = connect (FloodControlBotProtocol, floodrate = 1, floodburst = 1)
+		bot, clock = server.protocol, server.protocol.factory.clock
+		clock.pump ([1] * 10) # registration and joins
+		start = len (server.sent)
+		for i in range (3):
+			bot.msg ('#chat', 'line %d' % i)
+		bot.join ('#other')
+		bot.sendLine ('WHO #other')
+		server.send ('PING :loopback')
+		clock.pump ([1] * 5)
+		self.assertEqual ([line.split (' ')[0] for line in server.sent[start:start + 6]],
+		                  ['PRIVMSG', 'PONG', 'JOIN', 'WHO', 'PRIVMSG', 'PRIVMSG'])
+
+	def test_unlimited (self):
+		server = connect (FloodControlBotProtocol, floodrate = 0)
+		start = len (server.sent)
+		for i in range (100):
+			server.protocol.msg ('#chat', 'line %d' % i)
+		self.assertEqual (len (server.sent) - start, 100)
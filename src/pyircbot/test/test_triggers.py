@@ -0,0 +1,50 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from pyircbot.evaluation import ListBulkingBotProtocol
+from pyircbot.patterns import KeywordSet
+from pyircbot.test.helpers import connect
+from pyircbot.triggers import TriggerBotProtocol, TriggerEngine
+from twisted.trial import unittest
+
+class Stack (TriggerBotProtocol, ListBulkingBotProtocol):
+	pass
+
+class TriggerTest (unittest.TestCase):
+	'''
+	I check which triggers fire and what they run
+	'''
+	def test_keywords (self):
+		keywords = KeywordSet (['build failed', 'deploy', 'Ping'])
+		self.assertEqual (keywords.findall ('the BUILD failed again, deploy now'), [0, 1])
+		self.assertEqual (keywords.findall ('redeploying and pinging'), [])
+		self.assertEqual (keywords.findall ('ping'), [2])
+
+	def test_engine (self):
+		engine = TriggerEngine ([('deploy', 'first'), ('/v[0-9]+/', 'second')])
+		self.assertEqual (engine.commands ('deploy v2'), ['first', 'second'])
+		self.assertEqual (engine.commands ('nothing here'), [])
+
+	def test_protocol (self):
+		server = connect (Stack, triggers = {'*': {'hello': 'echo Heard'}, '#quiet': {}}, triggerlimit = 1)
+		self.assertEqual (server.say ('user!u@host', '#test', 'hello there'),
+		                  ['PRIVMSG #test : \x02Heard:\x02 hello there'])
+		self.assertEqual (server.say ('user!u@host', '#test', '!echo hello'),
+		                  ['PRIVMSG #test : \x02hello:\x02'])
+		self.assertEqual (server.say ('user!u@host', 'bot', 'hello'), [])
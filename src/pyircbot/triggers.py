@@ -0,0 +1,85 @@
+#!/usr/bin/python
+#
+# PyIRCBot
+# Copyright (C) Pierre Jaury 2011 <pierre@jaury.eu>
+# 
+# PyIRCBot is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ognbot is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from core import BotProtocol
+from patterns import KeywordSet, PatternSet
+import re
+
+class TriggerEngine (object):
+	'''
+	I am a compiled set of passive triggers, as (trigger, command line)
+	tuples. Triggers written between slashes are regular expressions, all
+	combined in a `PatternSet`, others are keywords, all compiled in a
+	`KeywordSet`; both are matched regardless of case
+	'''
+	def __init__ (self, triggers):
+		self.triggers = list (triggers)
+		regex = lambda trigger: len (trigger) > 1 and trigger[0] == trigger[-1] == '/'
+		self._keywordindexes = [index for index, (trigger, command) in enumerate (self.triggers) if not regex (trigger)]
+		self._patternindexes = [index for index, (trigger, command) in enumerate (self.triggers) if regex (trigger)]
+		self._keywords = KeywordSet ([self.triggers[index][0] for index in self._keywordindexes])
+		self._patterns = PatternSet ([self.triggers[index][0][1:-1] for index in self._patternindexes], re.I)
+
+	def commands (self, text):
+		'''
+		Returns the command lines of every trigger matching the text
+		'''
+		found = ([self._keywordindexes[index] for index in self._keywords.findall (text)] +
+		         [self._patternindexes[index] for index in self._patterns.findall (text)])
+		return [self.triggers[index][1] for index in sorted (found)]
+
+class TriggerBotProtocol (BotProtocol):
+	'''
+	I am a bot protocol which runs commands when channel messages match
+	passive triggers, read from the factory `triggers` dictionary:
+	
+		{'#channel': {'keyword': 'command line', '/regex/': 'command line'},
+		 '*': {...}}
+	
+	Triggers of '*' apply to every channel. The message is the input flow
+	of the command, which is checked as if the user had run it; at most
+	`triggerlimit` commands run for a single message.
+	
+	Triggers of every channel are compiled once, so please either replace
+	the factory `triggers` dictionary or call `invalidate` on the factory
+	whenever they change
+	'''
+	def _triggers (self, channel):
+		'''
+		Returns the trigger engine of the given channel
+		'''
+		engines = getattr (self.factory, '_triggerengines', None)
+		if engines is None or not (engines[0] is self.factory.triggers and engines[1] == self.factory.generation):
+			triggers = dict ([(name.lower (), value) for name, value in self.factory.triggers.items ()])
+			engines = self.factory._triggerengines = (self.factory.triggers, self.factory.generation, triggers, {})
+		triggers, compiled = engines[2:]
+		name = channel.lower () if channel.lower () in triggers else '*'
+		if not name in compiled:
+			channeltriggers = dict (triggers.get ('*', {}))
+			channeltriggers.update (triggers.get (name, {}))
+			compiled[name] = TriggerEngine (sorted (channeltriggers.items ()))
+		return compiled[name]
+
+	def privmsg (self, user, channel, message):
+		super(TriggerBotProtocol, self).privmsg (user, channel, message)
+		if channel[0] == '#' and getattr (self.factory, 'triggers', None) and not message.startswith (self.factory.bang):
+			for command in self._triggers (channel).commands (message)[:getattr (self.factory, 'triggerlimit', 3)]:
+				self.factory.metrics.count ('triggers')
+				if self._admit (user, channel, command):
+					self._handle (user, channel, command, True).callback ([message])
@@ -17,13 +17,53 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from core import BotProtocol, botcommand
-from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
-import re
+from patterns import PatternSet
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue, succeed
+
+class RawMatcher (object):
+	'''
+	I am the compiled form of the allow and deny rules of a raw command
+	'''
+	def __init__ (self, allow, deny):
+		self.allow = PatternSet (allow)
+		self.deny = PatternSet (deny)
+
+	def check (self, args):
+		'''
+		Returns whether the arguments are allowed, along with the rule that
+		decided, None if no rule matched at all
+		'''
+		index = self.deny.search (args)
+		if index is not None: # any deny rule wins
+			return False, self.deny.rules[index]
+		index = self.allow.search (args)
+		if index is not None:
+			return True, self.allow.rules[index]
+		return False, None
 
 class RawBotProtocol (BotProtocol):
 	'''
 	I am a bot protocol that alows the user to send raw information to the server
 	'''			
+	def _matcher (self, command):
+		'''
+		Returns the compiled rules for the given command, None if the command
+		is not allowed at all. Rules are compiled again whenever the factory
+		`do` dictionary is replaced or the factory is invalidated
+		'''
+		matchers = getattr (self.factory, '_rawmatchers', None)
+		if (matchers is None or not matchers[0] is self.factory.do
+		    or not matchers[1] == self.factory.generation):
+			matchers = (self.factory.do, self.factory.generation, {})
+			self.factory._rawmatchers = matchers
+		if command not in matchers[2]:
+			if command not in self.factory.do:
+				return None
+			allow, deny = self.factory.do[command]
+			matchers[2][command] = RawMatcher (allow, deny)
+		return matchers[2][command]
+
 	@botcommand
 	def do (self, flow, out, user, channel, *args):
 		'''
@@ -33,16 +73,10 @@ class RawBotProtocol (BotProtocol):
 		'''
 		command = args[0]
 		args = ' '.join (args[1:])
-		allowed = False
-		if command in self.factory.do:
-			for regexp in self.factory.do[command][0]:
-				if re.search (regexp, args):
-					allowed = True
-			for regexp in self.factory.do[command][1]:
-				if re.search (regexp, args):
-					allowed = False
+		matcher = self._matcher (command)
+		allowed, rule = matcher.check (args) if matcher else (False, None)
 		if not allowed:
-			out.append ('\x02Error\x02 Command not allowed')
+			out.append ('\x02Error\x02 Command not allowed' + (' by rule %s' % rule if rule else ''))
 		else:
 			out .append ('\x02Do:\x02 [%s] %s' % (command, args))
 			self.command (out, command, args)
@@ -51,8 +85,25 @@ class WhoBotProtocol (BotProtocol):
 	'''
 	I am a bot protocol which implements the /who command to list users
 	from a specific channel
+	
+	I maintain an index of the members of every channel I am in, seeded by
+	NAMES replies when joining and kept up to date with JOIN, PART, QUIT,
+	KICK, NICK and MODE events. WHO queries are only sent when needed: for
+	the first who command on a channel, then once its index is older than
+	the factory `whottl` seconds, and for members whose hostmask is not
+	known yet
 	'''
 	def _who (self, channel):
+		channel = channel.lower ()
+		refreshed = self._refreshed.get (channel)
+		if refreshed is not None and self._clock.seconds () - refreshed < self._whottl:
+			return succeed (self._members[channel].values ())
+		return self._query (channel)
+
+	def _query (self, channel):
+		'''
+		Sends a WHO query for the given channel unless one is running
+		'''
 		if channel in self._whoqueries:
 			return self._whoqueries[channel]
 		else:
@@ -61,20 +112,118 @@ class WhoBotProtocol (BotProtocol):
 			self.sendLine ('WHO %s' % channel)
 			return self._whoqueries[channel]
 
+	def _hostmask (self, nick):
+		'''
+		Returns the last known hostmask of the given nickname, None if
+		unknown, in which case it is queried in the background if the
+		nickname is in one of my channels
+		'''
+		nick = nick.lower ()
+		hostmask = self._hostmasks.get (nick)
+		if hostmask is None and not nick in self._lookups:
+			if any ([nick in members for members in self._members.values ()]):
+				self._lookups.add (nick)
+				self.sendLine ('WHO %s' % nick)
+		return hostmask
+
+	def _forget (self, nick):
+		'''
+		Forgets about the hostmask of a user who is no longer in any channel
+		'''
+		nick = nick.lower ()
+		if not any ([nick in members for members in self._members.values ()]):
+			self._hostmasks.pop (nick, None)
+
 	def irc_RPL_WHOREPLY (self, *nargs):
 		server, args = nargs
-		if args[1] in self._whoqueries:
-			self._whobuffers[args[1]].append ((args[5], args[3], args[6]))
-			
+		channel, nick = args[1].lower (), args[5]
+		self._hostmasks[nick.lower ()] = '%s!%s@%s' % (nick, args[2], args[3])
+		if channel in self._whoqueries:
+			self._whobuffers[channel].append ((args[5], args[3], args[6]))
+
 	def irc_RPL_ENDOFWHO (self, *nargs):
 		server, args = nargs
-		if args[1] in self._whoqueries:
-			self._whoqueries[args[1]].callback (self._whobuffers[args[1]])
-			del self._whoqueries[args[1]]
-			del self._whobuffers[args[1]]
-	
+		channel = args[1].lower ()
+		self._lookups.discard (channel)
+		if channel in self._whoqueries:
+			result = self._whobuffers[channel]
+			self._members[channel] = dict ([(x[0].lower (), x) for x in result])
+			self._refreshed[channel] = self._clock.seconds ()
+			self._whoqueries[channel].callback (result)
+			del self._whoqueries[channel]
+			del self._whobuffers[channel]
+
+	def irc_RPL_NAMREPLY (self, prefix, params):
+		channel = params[2].lower ()
+		if channel in self._members:
+			prefixes = ''.join ([x[0] for x in self.supported.getFeature ('PREFIX', {}).values ()])
+			for name in params[3].split ():
+				nick = name.lstrip (prefixes)
+				if nick.lower () not in self._members[channel]:
+					self._members[channel][nick.lower ()] = (nick, None, 'H' + name[:len (name) - len (nick)])
+
+	def irc_JOIN (self, prefix, params):
+		nick, channel = prefix.split ('!')[0], params[-1].lower ()
+		if '!' in prefix:
+			self._hostmasks[nick.lower ()] = prefix
+		if channel in self._members and not nick == self.nickname:
+			self._members[channel][nick.lower ()] = (nick, prefix.split ('@')[-1], 'H')
+		super(WhoBotProtocol, self).irc_JOIN (prefix, params)
+
+	def joined (self, channel):
+		self._members[channel.lower ()] = {}
+		self._refreshed.pop (channel.lower (), None)
+		super(WhoBotProtocol, self).joined (channel)
+
+	def left (self, channel):
+		self._members.pop (channel.lower (), None)
+		self._refreshed.pop (channel.lower (), None)
+		super(WhoBotProtocol, self).left (channel)
+
+	def kickedFrom (self, channel, kicker, message):
+		self._members.pop (channel.lower (), None)
+		self._refreshed.pop (channel.lower (), None)
+		super(WhoBotProtocol, self).kickedFrom (channel, kicker, message)
+
+	def userLeft (self, user, channel):
+		self._members.get (channel.lower (), {}).pop (user.lower (), None)
+		self._forget (user)
+		super(WhoBotProtocol, self).userLeft (user, channel)
+
+	def userKicked (self, kickee, channel, kicker, message):
+		self._members.get (channel.lower (), {}).pop (kickee.lower (), None)
+		self._forget (kickee)
+		super(WhoBotProtocol, self).userKicked (kickee, channel, kicker, message)
+
+	def userQuit (self, user, quitMessage):
+		for members in self._members.values ():
+			members.pop (user.lower (), None)
+		self._hostmasks.pop (user.lower (), None)
+		super(WhoBotProtocol, self).userQuit (user, quitMessage)
+
+	def userRenamed (self, oldname, newname):
+		old, new = oldname.lower (), newname.lower ()
+		for members in self._members.values ():
+			if old in members:
+				members[new] = (newname,) + members.pop (old)[1:]
+		hostmask = self._hostmasks.pop (old, None)
+		if hostmask:
+			self._hostmasks[new] = newname + hostmask[len (oldname):]
+		super(WhoBotProtocol, self).userRenamed (oldname, newname)
+
+	def modeChanged (self, user, channel, set, modes, args):
+		members = self._members.get (channel.lower ())
+		if members is not None:
+			prefixes = self.supported.getFeature ('PREFIX', {})
+			for mode, nick in zip (modes, args):
+				if mode in prefixes and nick and nick.lower () in members:
+					nick, host, flags = members[nick.lower ()]
+					flags = flags.replace (prefixes[mode][0], '')
+					members[nick.lower ()] = (nick, host, flags + prefixes[mode][0] if set else flags)
+		super(WhoBotProtocol, self).modeChanged (user, channel, set, modes, args)
+
 	@inlineCallbacks	
-	@botcommand
+	@botcommand (cache = 10)
 	def who (self, flow, out, user, channel, what):
 		'''
 		\x02who\x02 <channel>
@@ -91,8 +240,12 @@ class WhoBotProtocol (BotProtocol):
 		'''
 		Initialization of specific attributes
 		'''
+		self._clock = getattr (self.factory, 'clock', reactor)
+		self._whottl = getattr (self.factory, 'whottl', 300)
 		self._whoqueries = {}
 		self._whobuffers = {}
+		self._members = {}
+		self._refreshed = {}
+		self._hostmasks = {}
+		self._lookups = set ()
 		super(WhoBotProtocol, self).connectionMade ()
-
-